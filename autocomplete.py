@@ -0,0 +1,81 @@
+"""
+In-memory typeahead over reference data names.
+
+PrefixIndex answers "names starting with what the user typed" from one
+sorted list of keys: each name contributes one key per word, so "aura"
+finds "Migraine with aura", and a pair of bisects finds the block of keys
+that start with the query, the same walk a trie would do but in flat
+lists. When there are not enough prefix matches, names sharing enough
+character trigrams with the query are added so small typos still match.
+Results are ranked by how often the user picked them before.
+"""
+import heapq
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+
+FUZZY_MIN_QUERY = 3
+FUZZY_MIN_SIMILARITY = 0.4
+
+
+def _fold(value):
+	return ' '.join(value.casefold().split())
+
+
+def _trigrams(value):
+	padded = f"  {value} "
+	return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class PrefixIndex:
+	def __init__(self, items):
+		"""items: (id, display name) pairs"""
+		self.names = {}
+		self.trigrams = defaultdict(set)
+		keys = []
+		for item_id, name in items:
+			self.names[item_id] = name
+			folded = _fold(name)
+			words = folded.split(' ')
+			for i in range(len(words)):
+				keys.append((' '.join(words[i:]), item_id))
+			for gram in _trigrams(folded):
+				self.trigrams[gram].add(item_id)
+		keys.sort()
+		self.keys = [key for key, _ in keys]
+		self.ids = [item_id for _, item_id in keys]
+
+	def __len__(self):
+		return len(self.names)
+
+	def prefix_matches(self, query):
+		"""Ids of names with a word sequence starting with query"""
+		query = _fold(query)
+		lo = bisect_left(self.keys, query)
+		hi = bisect_left(self.keys, query + '\U0010ffff', lo)
+		return set(self.ids[lo:hi])
+
+	def fuzzy_matches(self, query):
+		"""{id: similarity} for names sharing enough trigrams with query"""
+		grams = _trigrams(_fold(query))
+		shared = Counter()
+		for gram in grams:
+			shared.update(self.trigrams.get(gram, ()))
+		return {item_id: count / len(grams) for item_id, count in shared.items()
+			if count / len(grams) >= FUZZY_MIN_SIMILARITY}
+
+	def search(self, query, k=10, usage=None):
+		"""
+		Top k (id, name) pairs for query: prefix matches first, then fuzzy
+		ones, each ordered by usage count, then shorter names, then name
+		"""
+		usage = usage or {}
+		names = self.names
+		prefix = self.prefix_matches(query)
+		results = heapq.nsmallest(k, prefix,
+			key=lambda i: (-usage.get(i, 0), len(names[i]), names[i].casefold()))
+		if len(results) < k and len(_fold(query)) >= FUZZY_MIN_QUERY:
+			fuzzy = {i: score for i, score in self.fuzzy_matches(query).items() if i not in prefix}
+			results += heapq.nsmallest(k - len(results), fuzzy,
+				key=lambda i: (-usage.get(i, 0), -fuzzy[i], names[i].casefold()))
+		return [(i, names[i]) for i in results]
@@ -0,0 +1,109 @@
+"""
+Typed rows for the migraine tracker tables.
+
+Each class declares its fields in the same order as the columns of the
+matching *_COLUMNS constant, so an object is built straight from a
+SQLAlchemy Row with Class(*row) instead of copying it into a dict.
+The classes use __slots__, which keeps them small when a page or an
+export holds many of them.
+"""
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterator, Optional
+
+from sqlalchemy import text
+
+
+EPISODE_COLUMNS = """id, user_id, start_time, end_time, intensity, attack_type_id,
+	had_menses, notes, created_at, version"""
+MEDICATION_COLUMNS = "id, generic_name, milligrams, route"
+REFERENCE_COLUMNS = "id, name"
+
+
+@dataclass(slots=True)
+class Episode:
+	id: int
+	user_id: int
+	start_time: datetime
+	end_time: Optional[datetime]
+	intensity: int
+	attack_type_id: Optional[int]
+	had_menses: bool
+	notes: Optional[str]
+	created_at: Optional[datetime]
+	version: int
+
+	def as_json(self):
+		"""JSON-ready dict with ISO 8601 timestamps"""
+		return {
+			'id': self.id,
+			'user_id': self.user_id,
+			'start_time': self.start_time.isoformat(),
+			'end_time': self.end_time.isoformat() if self.end_time else None,
+			'intensity': self.intensity,
+			'attack_type_id': self.attack_type_id,
+			'had_menses': self.had_menses,
+			'notes': self.notes,
+			'created_at': self.created_at.isoformat() if self.created_at else None,
+			'version': self.version
+		}
+
+
+@dataclass(slots=True)
+class Medication:
+	id: int
+	generic_name: str
+	milligrams: Optional[float]
+	route: Optional[str]
+
+
+@dataclass(slots=True)
+class ReferenceItem:
+	"""A row of one of the id/name tables: attack types, symptoms, triggers, pain locations"""
+	id: int
+	name: str
+
+
+def iter_episodes(result) -> Iterator[Episode]:
+	"""Episodes from the rows of a SELECT of EPISODE_COLUMNS, built one at a time"""
+	return (Episode(*row) for row in result)
+
+
+def recent_episodes(conn, limit=100) -> Iterator[Episode]:
+	"""Newest episodes first"""
+	return iter_episodes(conn.execute(text(f"""
+		SELECT {EPISODE_COLUMNS}
+		FROM pp2965.episodes
+		ORDER BY start_time DESC
+		LIMIT :limit
+	"""), {'limit': limit}))
+
+
+def episodes_with_ids(conn, ids) -> Iterator[Episode]:
+	return iter_episodes(conn.execute(text(f"""
+		SELECT {EPISODE_COLUMNS}
+		FROM pp2965.episodes
+		WHERE id = ANY(CAST(:ids AS integer[]))
+	"""), {'ids': list(ids)}))
+
+
+def get_episode(conn, episode_id) -> Optional[Episode]:
+	row = conn.execute(text(
+		f"SELECT {EPISODE_COLUMNS} FROM pp2965.episodes WHERE id = :id"
+	), {'id': episode_id}).fetchone()
+	return Episode(*row) if row is not None else None
+
+
+def get_medication(conn, med_id) -> Optional[Medication]:
+	row = conn.execute(text(
+		f"SELECT {MEDICATION_COLUMNS} FROM pp2965.medications WHERE id = :id"
+	), {'id': med_id}).fetchone()
+	return Medication(*row) if row is not None else None
+
+
+def get_reference_item(conn, table, item_id) -> Optional[ReferenceItem]:
+	"""A row of the id/name table pp2965.<table> (table must be a trusted name)"""
+	row = conn.execute(text(
+		f"SELECT {REFERENCE_COLUMNS} FROM pp2965.{table} WHERE id = :id"
+	), {'id': item_id}).fetchone()
+	return ReferenceItem(*row) if row is not None else None
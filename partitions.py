@@ -0,0 +1,324 @@
+"""
+Monthly range partitions for pp2965.episodes and its junction tables.
+
+episodes is partitioned by start_time and every junction table by a copy of
+its episode's start time (episode_start_time), with the same bounds, so the
+partitions for one month hold that month's episodes together with all their
+links. Queries on recent episodes only touch the recent partitions, and a
+month that is past retention is dropped as a whole: its rows are exported
+to gzip-compressed CSV files (with a header, loadable again with COPY FROM)
+and its partitions are detached and dropped, without a big DELETE.
+
+Partitions are named <table>_pYYYYMM. Rows outside every month partition
+(a backdated episode older than the first one, an episode in a month that
+was archived, or one past the months created so far) go to the DEFAULT
+partition <table>_default instead of being refused. split_default() later
+moves them into partitions of their own months, and archive_partitions()
+exports and deletes the expired ones. Keep partitions created ahead of time
+(create_partitions) so the DEFAULT partitions stay small.
+"""
+import gzip
+import os
+import re
+from datetime import date, datetime
+
+from sqlalchemy import text
+
+
+PARTITION_NAME = re.compile(r'_p(\d{4})(\d{2})$')
+
+
+def month_start(day):
+	return date(day.year, day.month, 1)
+
+
+def add_months(month, count):
+	index = month.year * 12 + month.month - 1 + count
+	return date(index // 12, index % 12 + 1, 1)
+
+
+def months(first, last):
+	"""The first days of the months from first to last, inclusive"""
+	month = month_start(first)
+	while month <= last:
+		yield month
+		month = add_months(month, 1)
+
+
+def partition_name(table, month):
+	return f"{table}_p{month:%Y%m}"
+
+
+def partition_key(table):
+	"""Column pp2965.<table> is partitioned by"""
+	return 'start_time' if table == 'episodes' else 'episode_start_time'
+
+
+def is_partitioned(conn):
+	return conn.execute(text(
+		"SELECT relkind = 'p' FROM pg_class WHERE oid = 'pp2965.episodes'::regclass"
+	)).scalar()
+
+
+def episode_partitions(conn):
+	"""{first day of month: partition name} of the partitions of pp2965.episodes"""
+	partitions = {}
+	for (name,) in conn.execute(text("""
+		SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+		WHERE i.inhparent = 'pp2965.episodes'::regclass
+	""")):
+		match = PARTITION_NAME.search(name)
+		if match:
+			partitions[date(int(match[1]), int(match[2]), 1)] = name
+	return partitions
+
+
+def create_default_partitions(conn, links):
+	"""DEFAULT partitions of episodes and of each junction table in links (caller commits)"""
+	for table in ['episodes'] + [table for table, _ in links]:
+		conn.execute(text(f"CREATE TABLE IF NOT EXISTS pp2965.{table}_default PARTITION OF pp2965.{table} DEFAULT"))
+
+
+def _has_default(conn):
+	return conn.execute(text("SELECT to_regclass('pp2965.episodes_default') IS NOT NULL")).scalar()
+
+
+def _in_month(table, month):
+	"""SQL condition: a row of pp2965.<table> belongs to month"""
+	key = partition_key(table)
+	return f"{key} >= '{month}' AND {key} < '{add_months(month, 1)}'"
+
+
+def _add_month(conn, links, month):
+	"""
+	Create the partitions of one month, moving that month's rows out of the
+	DEFAULT partitions: a month partition cannot be created while the DEFAULT
+	one holds rows of its range. Each partition is built as a plain table,
+	filled and then attached, episodes first so that the junction rows find
+	their episodes when their foreign keys are checked.
+	"""
+	tables = ['episodes'] + [table for table, _ in links]
+	has_default = _has_default(conn)
+	for table in tables:
+		conn.execute(text(f"""
+			CREATE TABLE pp2965.{partition_name(table, month)}
+			(LIKE pp2965.{table} INCLUDING DEFAULTS{' INCLUDING GENERATED' if table == 'episodes' else ''})
+		"""))
+		if has_default:
+			columns = ', '.join(_columns(conn, table))
+			conn.execute(text(f"""
+				INSERT INTO pp2965.{partition_name(table, month)} ({columns})
+				SELECT {columns} FROM pp2965.{table}_default WHERE {_in_month(table, month)}
+			"""))
+	if has_default:
+		# Junction rows first, so deleting the episodes cascades to nothing
+		for table in reversed(tables):
+			conn.execute(text(f"DELETE FROM pp2965.{table}_default WHERE {_in_month(table, month)}"))
+	for table in tables:
+		conn.execute(text(f"""
+			ALTER TABLE pp2965.{table} ATTACH PARTITION pp2965.{partition_name(table, month)}
+			FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')
+		"""))
+
+
+def create_partitions(conn, links, first, last):
+	"""
+	Create the partitions of episodes and of each (junction table, column) in
+	links for the months from first to last (caller commits). Returns the
+	months that were new.
+	"""
+	existing = episode_partitions(conn)
+	created = []
+	for month in months(first, last):
+		if month not in existing:
+			_add_month(conn, links, month)
+			created.append(month)
+	return created
+
+
+def default_months(conn):
+	"""First days of the months that have episodes in the DEFAULT partition"""
+	return [row[0] for row in conn.execute(text("""
+		SELECT DISTINCT CAST(date_trunc('month', start_time) AS date) FROM pp2965.episodes_default ORDER BY 1
+	"""))]
+
+
+def split_default(conn, links, since=None):
+	"""
+	Move the rows in the DEFAULT partitions into partitions of their own
+	months, for the months from since on (every month if None); caller
+	commits. Returns the months created.
+	"""
+	found = [month for month in default_months(conn) if since is None or month >= since]
+	for month in found:
+		_add_month(conn, links, month)
+	return found
+
+
+def _columns(conn, table):
+	"""Stored (not generated) columns of pp2965.<table>, in order"""
+	return [row[0] for row in conn.execute(text("""
+		SELECT attname FROM pg_attribute
+		WHERE attrelid = CAST(:table AS regclass) AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+		ORDER BY attnum
+	"""), {'table': f'pp2965.{table}'})]
+
+
+def partition_episodes(conn, links, months_ahead):
+	"""
+	Rebuild episodes and the junction tables in links as partitioned tables
+	holding the same rows, with DEFAULT partitions and month partitions from
+	the oldest episode's month to months_ahead months from now (caller
+	commits). Tables are locked for the copy. Returns False if episodes was
+	already partitioned.
+
+	Keys of partitioned tables must include the partition key, so episodes'
+	primary key becomes (id, start_time), the idempotency key index gets
+	start_time too, and junction rows reference (id, start_time). CHECK
+	constraints and foreign keys to other tables are recreated as they were.
+	A per-user exclusion constraint cannot span partitions and is not
+	recreated.
+	"""
+	if is_partitioned(conn):
+		return False
+	tables = ['episodes'] + [table for table, _ in links]
+	conn.execute(text(f"LOCK TABLE {', '.join(f'pp2965.{t}' for t in tables)} IN ACCESS EXCLUSIVE MODE"))
+
+	# CHECK constraints and foreign keys to recreate: episodes' own (user,
+	# attack type, intensity bounds) and the junction tables' references to
+	# the reference tables. LIKE copies neither; the keys to episodes change.
+	constraints = {table: [row[0] for row in conn.execute(text("""
+		SELECT pg_get_constraintdef(oid) FROM pg_constraint
+		WHERE conrelid = CAST(:table AS regclass)
+		  AND (contype = 'c' OR contype = 'f' AND confrelid <> 'pp2965.episodes'::regclass)
+		ORDER BY conname
+	"""), {'table': f'pp2965.{table}'})] for table in tables}
+	columns = {table: _columns(conn, table) for table in tables}
+	sequence = conn.execute(text("SELECT pg_get_serial_sequence('pp2965.episodes', 'id')")).scalar()
+	if sequence:
+		# The new table keeps using the id sequence after the old one is dropped
+		conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+	for table in tables:
+		conn.execute(text(f"ALTER TABLE pp2965.{table} RENAME TO {table}_unpartitioned"))
+
+	conn.execute(text("""
+		CREATE TABLE pp2965.episodes (
+			LIKE pp2965.episodes_unpartitioned INCLUDING DEFAULTS INCLUDING GENERATED
+		) PARTITION BY RANGE (start_time)
+	"""))
+	conn.execute(text("ALTER TABLE pp2965.episodes ADD PRIMARY KEY (id, start_time)"))
+	for table, column in links:
+		conn.execute(text(f"""
+			CREATE TABLE pp2965.{table} (LIKE pp2965.{table}_unpartitioned INCLUDING DEFAULTS)
+			PARTITION BY RANGE (episode_start_time)
+		"""))
+		conn.execute(text(f"""
+			ALTER TABLE pp2965.{table}
+			ALTER COLUMN episode_start_time SET NOT NULL,
+			ADD PRIMARY KEY (episode_id, {column}, episode_start_time)
+		"""))
+
+	create_default_partitions(conn, links)
+	oldest = conn.execute(text("SELECT min(start_time) FROM pp2965.episodes_unpartitioned")).scalar()
+	this_month = month_start(date.today())
+	first = month_start(oldest) if oldest is not None else this_month
+	create_partitions(conn, links, min(first, this_month), add_months(this_month, months_ahead))
+
+	episode_columns = ', '.join(columns['episodes'])
+	conn.execute(text(f"""
+		INSERT INTO pp2965.episodes ({episode_columns})
+		SELECT {episode_columns} FROM pp2965.episodes_unpartitioned
+	"""))
+	for table, column in links:
+		# episode_start_time is taken from the episode, it was not kept up to date before
+		copied = [c for c in columns[table] if c != 'episode_start_time']
+		conn.execute(text(f"""
+			INSERT INTO pp2965.{table} ({', '.join(copied)}, episode_start_time)
+			SELECT {', '.join(f'j.{c}' for c in copied)}, e.start_time
+			FROM pp2965.{table}_unpartitioned j
+			JOIN pp2965.episodes_unpartitioned e ON e.id = j.episode_id
+		"""))
+	for table in reversed(tables):
+		conn.execute(text(f"DROP TABLE pp2965.{table}_unpartitioned"))
+
+	conn.execute(text("CREATE INDEX episodes_start_time_idx ON pp2965.episodes (start_time)"))
+	conn.execute(text("CREATE INDEX episodes_user_start_time_idx ON pp2965.episodes (user_id, start_time)"))
+	conn.execute(text("""
+		CREATE UNIQUE INDEX episodes_user_idempotency_key
+		ON pp2965.episodes (user_id, idempotency_key, start_time)
+	"""))
+	btree_gist = conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'btree_gist'")).fetchone()
+	conn.execute(text(f"""
+		CREATE INDEX episodes_active_range_idx
+		ON pp2965.episodes USING gist ({'user_id, ' if btree_gist else ''}active_range)
+	"""))
+	for table, column in links:
+		conn.execute(text(f"""
+			ALTER TABLE pp2965.{table} ADD FOREIGN KEY (episode_id, episode_start_time)
+			REFERENCES pp2965.episodes (id, start_time) ON DELETE CASCADE ON UPDATE CASCADE
+		"""))
+		conn.execute(text(f"CREATE INDEX {table}_{column}_idx ON pp2965.{table} ({column})"))
+	for table in tables:
+		for definition in constraints[table]:
+			conn.execute(text(f"ALTER TABLE pp2965.{table} ADD {definition}"))
+	return True
+
+
+def _export(conn, source, path):
+	"""Write source (a table or a parenthesized query) to path as gzip-compressed CSV with a header"""
+	cursor = conn.connection.dbapi_connection.cursor()
+	try:
+		with open(path + '.tmp', 'wb') as raw:
+			with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+				cursor.copy_expert(f"COPY {source} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+			raw.flush()
+			os.fsync(raw.fileno())
+	finally:
+		cursor.close()
+	os.replace(path + '.tmp', path)
+
+
+def archive_partitions(conn, links, before, directory):
+	"""
+	Export, detach and drop the partitions of months that ended on or before
+	the month of before, one month per transaction, then export and delete
+	the rows of those months in the DEFAULT partitions (this commits).
+	Returns the paths of the files written.
+	"""
+	os.makedirs(directory, exist_ok=True)
+	written = []
+	for month, name in sorted(episode_partitions(conn).items()):
+		if add_months(month, 1) > month_start(before):
+			break
+		# Junction partitions first: the episodes partition can only be
+		# detached once nothing references its rows
+		junctions = [partition_name(table, month) for table, _ in links]
+		for table in junctions + [name]:
+			path = os.path.join(directory, f'{table}.csv.gz')
+			_export(conn, f'pp2965.{table}', path)
+			written.append(path)
+		for table in junctions:
+			conn.execute(text(f"DROP TABLE pp2965.{table}"))
+		conn.execute(text(f"ALTER TABLE pp2965.episodes DETACH PARTITION pp2965.{name}"))
+		conn.execute(text(f"DROP TABLE pp2965.{name}"))
+		conn.commit()
+	
+	cutoff = month_start(before)
+	if not _has_default(conn) or conn.execute(text(
+		"SELECT 1 FROM pp2965.episodes_default WHERE start_time < :cutoff LIMIT 1"
+	), {'cutoff': cutoff}).fetchone() is None:
+		return written
+	# Expired rows can reach the DEFAULT partitions at any time, so each
+	# export gets its own file name instead of a month's
+	tables = [table for table, _ in links] + ['episodes']
+	stamp = datetime.now().strftime('%Y%m%dT%H%M%S')
+	for table in tables:
+		path = os.path.join(directory, f'{table}_default_before{cutoff:%Y%m}_{stamp}.csv.gz')
+		columns = ', '.join(_columns(conn, table))
+		_export(conn, f"(SELECT {columns} FROM pp2965.{table}_default WHERE {partition_key(table)} < '{cutoff}')", path)
+		written.append(path)
+	for table in tables:
+		conn.execute(text(f"DELETE FROM pp2965.{table}_default WHERE {partition_key(table)} < :cutoff"),
+			{'cutoff': cutoff})
+	conn.commit()
+	return written
@@ -0,0 +1,194 @@
+"""
+Sampling profiler for single requests, with flame graphs per route.
+
+SamplingProfiler runs one background thread that, while any request is
+being profiled, looks at the stacks of those requests' threads every
+interval seconds (sys._current_frames) and counts each stack in collapsed
+form: frames from the outermost call inward joined with ';', the format
+flamegraph.pl and speedscope read. Nothing is traced, so the request runs
+at full speed apart from the short pauses of the sampler holding the GIL.
+
+ProfileStore appends each profiled request's stacks to <route>.folded in
+a directory, so the samples of every worker process end up in one place,
+and flame_graph() lays the merged stacks of a route out as boxes.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+
+FRAME_KINDS = (
+	('sql', ('sqlalchemy/', 'psycopg2/', 'psycopg/')),
+	('template', ('jinja2/', '.html')),
+	('framework', ('flask/', 'werkzeug/', 'gunicorn/', 'click/')),
+)
+
+
+def _short_filename(path):
+	"""Path below site-packages for libraries, the file name otherwise"""
+	_, found, below = path.replace(os.sep, '/').rpartition('-packages/')
+	return below if found else os.path.basename(path)
+
+
+def collapse(frame):
+	"""Collapsed stack of frame and its callers: 'outer (file.py);...;inner (pkg/file.py)'"""
+	names = []
+	while frame is not None:
+		code = frame.f_code
+		names.append(f"{code.co_name} ({_short_filename(code.co_filename)})")
+		frame = frame.f_back
+	return ';'.join(reversed(names))
+
+
+def frame_kind(frame):
+	"""'sql', 'template', 'framework' or 'python' for a collapsed frame"""
+	for kind, markers in FRAME_KINDS:
+		if any(marker in frame for marker in markers):
+			return kind
+	return 'python'
+
+
+def time_breakdown(stacks):
+	"""
+	Samples per kind of work: 'sql' for stacks inside the database driver or
+	SQLAlchemy, else 'template' inside Jinja, else 'python'
+	"""
+	kinds = Counter()
+	for stack, count in stacks.items():
+		frames = stack.split(';')
+		seen = {frame_kind(frame) for frame in frames}
+		kinds['sql' if 'sql' in seen else 'template' if 'template' in seen else 'python'] += count
+	return kinds
+
+
+class SamplingProfiler:
+	def __init__(self, interval=0.005):
+		self.interval = interval
+		self._active = {}  # thread id -> Counter of collapsed stacks
+		self._lock = threading.Lock()
+		self._wake = threading.Event()
+		self._thread = None
+
+	def start(self):
+		"""Start sampling the calling thread"""
+		with self._lock:
+			self._active[threading.get_ident()] = Counter()
+			# Also after a fork, which leaves the sampler thread behind in the parent
+			if self._thread is None or not self._thread.is_alive():
+				self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+				self._thread.start()
+		self._wake.set()
+
+	def stop(self):
+		"""Stop sampling the calling thread; returns its Counter of collapsed stacks"""
+		with self._lock:
+			return self._active.pop(threading.get_ident(), Counter())
+
+	def _run(self):
+		while True:
+			self._wake.wait()
+			with self._lock:
+				if not self._active:
+					self._wake.clear()
+					continue
+				idents = list(self._active)
+			frames = sys._current_frames()
+			stacks = {ident: collapse(frames[ident]) for ident in idents if ident in frames}
+			del frames
+			with self._lock:
+				for ident, stack in stacks.items():
+					if ident in self._active:
+						self._active[ident][stack] += 1
+			time.sleep(self.interval)
+
+
+class ProfileStore:
+	"""Collapsed stacks per route in <directory>/<route>.folded"""
+
+	def __init__(self, directory, max_bytes=8 * 1024 * 1024):
+		self.directory = directory
+		self.max_bytes = max_bytes
+
+	def _path(self, route):
+		return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', route) + '.folded')
+
+	def add(self, route, samples, seconds):
+		"""
+		Append one request's samples. A '#' line records the request and its
+		duration; collapsed-stack tools skip it. A file over max_bytes is
+		moved to <route>.folded.1, replacing the previous one.
+		"""
+		os.makedirs(self.directory, exist_ok=True)
+		path = self._path(route)
+		lines = [f"# {seconds * 1000:.1f}\n"] + [f"{stack} {count}\n" for stack, count in samples.items()]
+		try:
+			if os.path.getsize(path) > self.max_bytes:
+				os.replace(path, path + '.1')
+		except FileNotFoundError:
+			pass
+		# One write on an O_APPEND file, so concurrent workers do not interleave
+		fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+		try:
+			os.write(fd, ''.join(lines).encode())
+		finally:
+			os.close(fd)
+
+	def load(self, route):
+		"""(requests, total milliseconds, Counter of collapsed stacks) of a route"""
+		requests, total_ms, stacks = 0, 0.0, Counter()
+		try:
+			with open(self._path(route)) as f:
+				for line in f:
+					if line.startswith('#'):
+						requests += 1
+						total_ms += float(line[1:])
+					elif line.strip():
+						stack, _, count = line.rstrip('\n').rpartition(' ')
+						stacks[stack] += int(count)
+		except FileNotFoundError:
+			pass
+		return requests, total_ms, stacks
+
+	def routes(self):
+		"""Names of the routes that have samples"""
+		try:
+			return sorted(name[:-len('.folded')] for name in os.listdir(self.directory) if name.endswith('.folded'))
+		except FileNotFoundError:
+			return []
+
+	def clear(self, route):
+		for path in (self._path(route), self._path(route) + '.1'):
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+
+
+def flame_graph(stacks, min_share=0.002):
+	"""
+	Boxes of a flame graph of a Counter of collapsed stacks, as (depth, left,
+	width, frame, samples) with left and width as shares of all samples.
+	Frames narrower than min_share are left out with everything above them.
+	"""
+	total = sum(stacks.values())
+	tree = {}  # frame -> [samples, {callee frame: ...}]
+	for stack, count in stacks.items():
+		node = tree
+		for frame in stack.split(';'):
+			entry = node.setdefault(frame, [0, {}])
+			entry[0] += count
+			node = entry[1]
+	boxes = []
+	pending = [(tree, 0, 0)]
+	while pending:
+		node, depth, left = pending.pop()
+		for frame, (count, callees) in sorted(node.items()):
+			if count / total >= min_share:
+				boxes.append((depth, left / total, count / total, frame, count))
+				pending.append((callees, depth + 1, left))
+			left += count
+	boxes.sort()
+	return boxes
@@ -0,0 +1,76 @@
+"""
+Token-bucket rate limiting.
+
+Each key (a user or a client address) owns a bucket holding up to burst
+tokens that refills at rate tokens per second; a request takes one token
+or is refused with the time until the next token. Buckets live in this
+process (MemoryBackend) or in Redis (RedisBackend) so that every worker
+and every server shares the same budget.
+"""
+import threading
+import time
+
+
+class MemoryBackend:
+	"""Buckets in a dict, for a single process"""
+
+	max_keys = 100000
+
+	def __init__(self):
+		self._buckets = {}
+		self._lock = threading.Lock()
+
+	def take(self, key, rate, burst):
+		"""Take a token from key's bucket; returns (allowed, seconds until retry)"""
+		now = time.monotonic()
+		with self._lock:
+			tokens, updated = self._buckets.get(key, (burst, now))
+			tokens = min(burst, tokens + (now - updated) * rate)
+			allowed = tokens >= 1
+			if allowed:
+				tokens -= 1
+			if len(self._buckets) >= self.max_keys and key not in self._buckets:
+				self._prune(now, rate, burst)
+			self._buckets[key] = (tokens, now)
+		return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+	def _prune(self, now, rate, burst):
+		"""Forget buckets that have refilled completely (they equal a new bucket)"""
+		for key, (tokens, updated) in list(self._buckets.items()):
+			if tokens + (now - updated) * rate >= burst:
+				del self._buckets[key]
+
+
+class RedisBackend:
+	"""Buckets in Redis hashes, updated atomically by a Lua script"""
+
+	_script = """
+		local tokens = tonumber(redis.call('HGET', KEYS[1], 't'))
+		local updated = tonumber(redis.call('HGET', KEYS[1], 'u'))
+		local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+		if tokens == nil then tokens, updated = burst, now end
+		tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+		local allowed = 0
+		if tokens >= 1 then tokens = tokens - 1; allowed = 1 end
+		redis.call('HSET', KEYS[1], 't', tostring(tokens), 'u', tostring(now))
+		redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+		return {allowed, tostring(tokens)}
+	"""
+
+	def __init__(self, url, prefix='ratelimit:'):
+		import redis
+		self._redis = redis.Redis.from_url(url)
+		self._take = self._redis.register_script(self._script)
+		self._prefix = prefix
+
+	def take(self, key, rate, burst):
+		allowed, tokens = self._take(keys=[self._prefix + key], args=[rate, burst, time.time()])
+		tokens = float(tokens)
+		return bool(allowed), 0.0 if allowed else (1 - tokens) / rate
+
+
+def make_backend(redis_url=None):
+	"""RedisBackend when a URL is given (needs the redis package), else MemoryBackend"""
+	if redis_url:
+		return RedisBackend(redis_url)
+	return MemoryBackend()
@@ -0,0 +1,155 @@
+"""
+Cohort reports over all users, answered from a columnar snapshot.
+
+snapshot() copies the columns the reports need from the episode, junction
+and reference tables into Parquet files (pyarrow), streaming the rows in
+batches inside one REPEATABLE READ transaction so the tables agree with
+each other. Each snapshot goes to its own directory and the CURRENT file
+is switched to it only once it is complete, so readers never see a half
+written snapshot. cohort_report() then runs the aggregations with DuckDB
+over those files; the database only ever sees the sequential copy.
+"""
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+
+SNAPSHOT_BATCH_ROWS = 50000
+SNAPSHOTS_KEPT = 2
+
+# table -> (columns and their Arrow types, query); notes and times are left
+# out, the reports do not need them
+SNAPSHOT_TABLES = {
+	'episodes': (
+		[('id', 'int32'), ('user_id', 'int32'), ('intensity', 'int16'),
+			('attack_type_id', 'int32'), ('had_menses', 'bool_')],
+		"SELECT id, user_id, intensity, attack_type_id, had_menses FROM pp2965.episodes"),
+	'episode_triggers': (
+		[('episode_id', 'int32'), ('trigger_id', 'int32')],
+		"SELECT episode_id, trigger_id FROM pp2965.episode_triggers"),
+	'episode_symptoms': (
+		[('episode_id', 'int32'), ('symptom_id', 'int32')],
+		"SELECT episode_id, symptom_id FROM pp2965.episode_symptoms"),
+	'episode_pain_locations': (
+		[('episode_id', 'int32'), ('pain_location_id', 'int32')],
+		"SELECT episode_id, pain_location_id FROM pp2965.episode_pain_locations"),
+	'episode_medications': (
+		[('episode_id', 'int32'), ('medication_id', 'int32')],
+		"SELECT episode_id, medication_id FROM pp2965.episode_medications"),
+	'attack_types': (
+		[('id', 'int32'), ('name', 'string')],
+		"SELECT id, name FROM pp2965.attack_types"),
+	'triggers': (
+		[('id', 'int32'), ('name', 'string')],
+		"SELECT id, name FROM pp2965.triggers"),
+}
+
+COHORT_QUERIES = {
+	'trigger_prevalence': """
+		WITH cohort AS (SELECT count(*) AS episodes, count(DISTINCT user_id) AS users FROM episodes)
+		SELECT t.id, t.name,
+			count(DISTINCT et.episode_id) AS episodes,
+			count(DISTINCT e.user_id) AS users,
+			count(DISTINCT et.episode_id) / any_value(cohort.episodes) AS episode_share,
+			count(DISTINCT e.user_id) / any_value(cohort.users) AS user_share
+		FROM episode_triggers et
+		JOIN episodes e ON e.id = et.episode_id
+		JOIN triggers t ON t.id = et.trigger_id
+		CROSS JOIN cohort
+		GROUP BY t.id, t.name
+		ORDER BY episodes DESC, t.name
+	""",
+	'intensity_by_attack_type': """
+		SELECT e.attack_type_id AS id, any_value(a.name) AS name,
+			count(*) AS episodes,
+			count(DISTINCT e.user_id) AS users,
+			avg(e.intensity) AS mean_intensity,
+			stddev_samp(e.intensity) AS stddev_intensity
+		FROM episodes e
+		LEFT JOIN attack_types a ON a.id = e.attack_type_id
+		GROUP BY e.attack_type_id
+		ORDER BY episodes DESC, name
+	""",
+	'menses': """
+		SELECT count(*) AS episodes,
+			count(*) FILTER (WHERE had_menses) AS menses_episodes,
+			avg(CASE WHEN had_menses THEN 1.0 ELSE 0.0 END) AS menses_rate,
+			count(DISTINCT user_id) FILTER (WHERE had_menses) AS menses_users,
+			avg(intensity) FILTER (WHERE had_menses) AS mean_intensity_menses,
+			avg(intensity) FILTER (WHERE NOT coalesce(had_menses, false)) AS mean_intensity_other,
+			corr(CASE WHEN had_menses THEN 1.0 ELSE 0.0 END, intensity) AS intensity_correlation
+		FROM episodes
+	""",
+}
+
+
+def current_snapshot(directory):
+	"""Path of the newest complete snapshot in directory, or None"""
+	try:
+		with open(os.path.join(directory, 'CURRENT')) as f:
+			return os.path.join(directory, f.read().strip())
+	except FileNotFoundError:
+		return None
+
+
+def snapshot(conn, directory):
+	"""Copy SNAPSHOT_TABLES into a new snapshot under directory and make it current"""
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+
+	taken_at = datetime.now(timezone.utc)
+	name = taken_at.strftime('snapshot-%Y%m%dT%H%M%S%fZ')
+	path = os.path.join(directory, name)
+	os.makedirs(path)
+	rows = {}
+	conn = conn.execution_options(isolation_level='REPEATABLE READ', stream_results=True,
+		yield_per=SNAPSHOT_BATCH_ROWS)
+	with conn.begin():
+		for table, (columns, query) in SNAPSHOT_TABLES.items():
+			schema = pa.schema([(column, getattr(pa, type_name)()) for column, type_name in columns])
+			rows[table] = 0
+			with pq.ParquetWriter(os.path.join(path, f'{table}.parquet'), schema) as writer:
+				for batch in conn.execute(text(query)).partitions():
+					arrays = [pa.array(values, type=field.type)
+						for values, field in zip(zip(*batch), schema)]
+					writer.write_batch(pa.record_batch(arrays, schema=schema))
+					rows[table] += len(batch)
+
+	with open(os.path.join(path, 'snapshot.json'), 'w') as f:
+		json.dump({'taken_at': taken_at.isoformat(), 'rows': rows}, f)
+	with open(os.path.join(directory, 'CURRENT.tmp'), 'w') as f:
+		f.write(name)
+	os.replace(os.path.join(directory, 'CURRENT.tmp'), os.path.join(directory, 'CURRENT'))
+
+	old = sorted(entry for entry in os.listdir(directory) if entry.startswith('snapshot-'))
+	for entry in old[:-SNAPSHOTS_KEPT]:
+		shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+	return path, rows
+
+
+def cohort_report(path):
+	"""Run COHORT_QUERIES over the snapshot at path; returns a JSON-ready dict"""
+	import duckdb
+
+	started = time.perf_counter()
+	db = duckdb.connect()
+	try:
+		for table in SNAPSHOT_TABLES:
+			file = os.path.join(path, f'{table}.parquet').replace("'", "''")
+			db.execute(f"CREATE VIEW {table} AS SELECT * FROM read_parquet('{file}')")
+		report = {}
+		for name, query in COHORT_QUERIES.items():
+			result = db.execute(query)
+			columns = [column[0] for column in result.description]
+			report[name] = [dict(zip(columns, row)) for row in result.fetchall()]
+	finally:
+		db.close()
+	report['menses'] = report['menses'][0]
+	with open(os.path.join(path, 'snapshot.json')) as f:
+		report['snapshot'] = json.load(f)
+	report['query_seconds'] = round(time.perf_counter() - started, 4)
+	return report
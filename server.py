@@ -8,14 +8,87 @@ Go to http://localhost:8111 in your browser.
 A debugger such as "pdb" may be helpful for debugging.
 Read about it online.
 """
+import time
+STARTUP_STARTED = time.perf_counter()
+
 import os
+import calendar
+import collections
+import gzip
+import hashlib
+import hmac
+import itertools
+import json
+import math
+import mimetypes
+import random
+import re
+import selectors
+import shlex
+import subprocess
+import threading
+import uuid
+import zlib
+from datetime import date, datetime
 # accessible as a variable in index.html:
 from sqlalchemy import *
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
 from sqlalchemy.pool import NullPool
-from flask import Flask, request, render_template, g, redirect, Response, abort
+import click
+from autocomplete import PrefixIndex
+from ratelimit import make_backend as make_rate_limit_backend
+from partitions import (add_months, archive_partitions, create_default_partitions, create_partitions, is_partitioned,
+	month_start, partition_episodes, split_default)
+from profiling import ProfileStore, SamplingProfiler, flame_graph, frame_kind, time_breakdown
+from validation import (EPISODE_FORM, EPISODE_JSON, EPISODE_UPDATE_FORM, MEDICATION_FORM, NAME_FORM, SYNC_REQUEST,
+	ValidationError)
+from reporting import cohort_report, current_snapshot, snapshot as snapshot_reports
+from models import (EPISODE_COLUMNS, episodes_with_ids, get_episode, get_medication, get_reference_item,
+	iter_episodes, recent_episodes)
+from jinja2 import FileSystemBytecodeCache, MemcachedBytecodeCache
+from flask import (Flask, request, render_template, g, redirect, Response, abort, jsonify, send_from_directory,
+	has_request_context)
+
+try:
+	import brotli
+except ImportError:  # optional: without it responses are gzip-only
+	brotli = None
+
+# (phase, milliseconds) recorded while the process starts, see startup_report()
+startup_timings = [('imports', (time.perf_counter() - STARTUP_STARTED) * 1000)]
+
+
+def record_startup(phase, started):
+	"""Add the time since started (a perf_counter value) to the startup profile"""
+	startup_timings.append((phase, (time.perf_counter() - started) * 1000))
+
+
+def _template_bytecode_cache():
+	"""
+	Where compiled templates are kept between processes: a shared memcached
+	when JINJA_MEMCACHED lists servers (needs pymemcache), otherwise a
+	directory shared by every worker on the machine: JINJA_CACHE_DIR, or
+	Jinja's default, a directory in the temp dir private to this user that
+	Jinja checks the owner and mode of (a fixed path there could be created
+	first by another user, who could then plant bytecode for us to run).
+	"""
+	servers = os.environ.get('JINJA_MEMCACHED')
+	if servers:
+		try:
+			from pymemcache.client.hash import HashClient
+			return MemcachedBytecodeCache(HashClient(servers.split(',')), prefix='migraine-tracker/jinja/')
+		except ImportError:
+			print("JINJA_MEMCACHED is set but pymemcache is not installed, using the file cache")
+	cache_dir = os.environ.get('JINJA_CACHE_DIR')
+	if not cache_dir:
+		return FileSystemBytecodeCache()
+	os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+	return FileSystemBytecodeCache(cache_dir)
+
 
 tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 app = Flask(__name__, template_folder=tmpl_dir)
+app.jinja_options = {**app.jinja_options, 'bytecode_cache': _template_bytecode_cache()}
 
 
 #
@@ -39,7 +112,47 @@ DATABASEURI = f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWRD}@{DATABASE_HO
 #
 # This line creates a database engine that knows how to connect to the URI above.
 #
-engine = create_engine(DATABASEURI)
+def make_engine(uri, pool_size=None, max_overflow=None):
+	"""
+	Engine with a connection pool sized from the arguments or from the
+	DB_POOL_SIZE / DB_MAX_OVERFLOW / DB_POOL_TIMEOUT environment variables.
+	Connecting gives up after DB_CONNECT_TIMEOUT seconds, so an unreachable
+	replica is skipped quickly instead of holding up the request.
+	"""
+	return create_engine(
+		uri,
+		connect_args={'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 5))},
+		pool_size=pool_size if pool_size is not None else int(os.environ.get('DB_POOL_SIZE', 5)),
+		max_overflow=max_overflow if max_overflow is not None else int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+		pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+		pool_pre_ping=True
+	)
+
+
+engine = make_engine(DATABASEURI)
+
+#
+# Optional streaming replicas of the database above, for read-only pages.
+# List their URIs comma-separated in REPLICA_DATABASEURIS.
+#
+REPLICA_DATABASEURIS = [uri.strip() for uri in os.environ.get('REPLICA_DATABASEURIS', '').split(',') if uri.strip()]
+replica_engines = [make_engine(uri) for uri in REPLICA_DATABASEURIS]
+
+
+def configure_pools(pool_size, max_overflow):
+	"""
+	Replace the engines with ones using the given pool size. Called in each
+	server worker right after fork: connections inherited from the parent
+	are dropped without being closed, since the parent still owns them.
+	"""
+	global engine, replica_engines
+	for old_engine in [engine] + replica_engines:
+		old_engine.dispose(close=False)
+	engine = make_engine(DATABASEURI, pool_size, max_overflow)
+	replica_engines = [make_engine(uri, pool_size, max_overflow) for uri in REPLICA_DATABASEURIS]
+	resize_write_slots(pool_size + max_overflow)
+
+schema_started = time.perf_counter()
 
 #
 # Example of running queries in your database
@@ -58,6 +171,104 @@ with engine.connect() as conn:
 	# you need to commit for create, insert, update queries to reflect
 	conn.commit()
 
+	# Optimistic concurrency (version) and idempotent creates (idempotency_key)
+	conn.execute(text("""
+		ALTER TABLE pp2965.episodes
+			ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1,
+			ADD COLUMN IF NOT EXISTS updated_at timestamp,
+			ADD COLUMN IF NOT EXISTS idempotency_key text
+	"""))
+	conn.execute(text("""
+		CREATE UNIQUE INDEX IF NOT EXISTS episodes_user_idempotency_key
+		ON pp2965.episodes (user_id, idempotency_key)
+	"""))
+
+	# Time span of each episode as a range, see EPISODE TIME SPANS below. A
+	# generated column must be immutable, so the range type follows start_time:
+	# tstzrange for timestamptz, tsrange for a plain timestamp.
+	start_time_type = conn.execute(text("""
+		SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+		WHERE attrelid = 'pp2965.episodes'::regclass AND attname = 'start_time'
+	""")).scalar()
+	if start_time_type == 'timestamp with time zone':
+		EPISODE_TIME_TYPE, EPISODE_RANGE_TYPE = 'timestamptz', 'tstzrange'
+	else:
+		EPISODE_TIME_TYPE, EPISODE_RANGE_TYPE = 'timestamp', 'tsrange'
+	conn.execute(text(f"""
+		ALTER TABLE pp2965.episodes ADD COLUMN IF NOT EXISTS active_range {EPISODE_RANGE_TYPE}
+		GENERATED ALWAYS AS ({EPISODE_RANGE_TYPE}(start_time,
+			CASE WHEN end_time IS NOT NULL THEN GREATEST(start_time, end_time) END, '[]')) STORED
+	"""))
+	try:
+		# Lets user_id (=) share a GiST index with the range (&&)
+		with conn.begin_nested():
+			conn.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gist"))
+		btree_gist = True
+	except Exception as e:
+		print(f"btree_gist unavailable, episode ranges are indexed without user_id: {e}")
+		btree_gist = False
+	conn.execute(text(f"""
+		CREATE INDEX IF NOT EXISTS episodes_active_range_idx
+		ON pp2965.episodes USING gist ({'user_id, ' if btree_gist else ''}active_range)
+	"""))
+	if os.environ.get('EPISODE_NO_OVERLAP') == '1' and btree_gist:
+		constraint = conn.execute(text(
+			"SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE conname = 'episodes_no_overlap'"
+		)).scalar()
+		try:
+			# Compares spans, in which an ongoing episode is just its start time
+			# (see EPISODE TIME SPANS); the first version compared active_range
+			if constraint is None or 'active_range' in constraint:
+				with conn.begin_nested():
+					conn.execute(text("ALTER TABLE pp2965.episodes DROP CONSTRAINT IF EXISTS episodes_no_overlap"))
+					conn.execute(text(f"""
+						ALTER TABLE pp2965.episodes ADD CONSTRAINT episodes_no_overlap
+						EXCLUDE USING gist (user_id WITH =,
+							({EPISODE_RANGE_TYPE}(start_time, GREATEST(start_time, end_time), '[]')) WITH &&)
+					"""))
+		except Exception as e:
+			print(f"Could not add episodes_no_overlap (overlapping episodes, or a partitioned table?): {e}")
+
+	# Start time of the episode on each junction row: the key the junction
+	# tables are partitioned by, see PARTITIONING below
+	for table in ('episode_pain_locations', 'episode_symptoms', 'episode_triggers', 'episode_medications'):
+		conn.execute(text(f"""
+			ALTER TABLE pp2965.{table} ADD COLUMN IF NOT EXISTS episode_start_time {EPISODE_TIME_TYPE}
+		"""))
+
+	# Outbox of episode and reference-data mutations, see CHANGE FEED below
+	conn.execute(text("""
+		CREATE TABLE IF NOT EXISTS pp2965.change_feed (
+			seq bigserial PRIMARY KEY,
+			entity text NOT NULL,
+			entity_id integer NOT NULL,
+			op text NOT NULL,
+			user_id integer,
+			changed_at timestamp NOT NULL DEFAULT NOW()
+		)
+	"""))
+
+	# lower(name) indexes for the prefix search and ordering of the reference list pages
+	for table, name_column in (('medications', 'generic_name'), ('symptoms', 'name'), ('triggers', 'name'),
+			('pain_locations', 'name'), ('attack_types', 'name')):
+		conn.execute(text(f"""
+			CREATE INDEX IF NOT EXISTS {table}_lower_name_idx
+			ON pp2965.{table} ((lower({name_column}) COLLATE "C"))
+		"""))
+
+	# Calendar heatmap store: one row per user-year, one byte per day of the
+	# year holding the max episode intensity (0 = no headache that day).
+	conn.execute(text("""
+		CREATE TABLE IF NOT EXISTS pp2965.episode_day_intensity (
+			user_id integer NOT NULL,
+			year integer NOT NULL,
+			days bytea NOT NULL,
+			PRIMARY KEY (user_id, year)
+		)
+	"""))
+	conn.commit()
+record_startup('database connect + schema', schema_started)
+
 
 @app.before_request
 def before_request():
@@ -68,8 +279,15 @@ def before_request():
 
 	The variable g is globally accessible.
 	"""
+	start_profile()
+	rejected = admit_request()
+	if rejected is not None:
+		return rejected
 	try:
-		g.conn = engine.connect()
+		g.conn = connect_for_request()
+	except PoolTimeoutError:
+		g.conn = None
+		return shed_request('pool_timeout')
 	except:
 		print("uh oh, problem connecting to database")
 		import traceback; traceback.print_exc()
@@ -81,10 +299,602 @@ def teardown_request(exception):
 	At the end of the web request, this makes sure to close the database connection.
 	If you don't, the database could run out of memory!
 	"""
+	release_write_slot()
 	try:
 		g.conn.close()
 	except Exception as e:
 		pass
+	# Caches made stale by this request's writes are dropped only now that
+	# the writes are committed: dropped earlier, a concurrent request could
+	# reload them from the old data and keep that until they expire
+	stale = g.pop('stale_caches', None)
+	if stale:
+		drop_stale_caches(stale)
+	finish_profile()
+
+
+#
+# READ REPLICA ROUTING
+#
+# Views marked @read_only are served from a replica on GET/HEAD; everything
+# else uses the primary. After a write the client gets a short-lived cookie
+# that pins its reads to the primary for READ_YOUR_WRITES_SECONDS, so it
+# always sees its own changes even while the replicas catch up. Replicas
+# lagging more than REPLICA_MAX_LAG_SECONDS are skipped. Routing counts and
+# replica lag are exported on /metrics.
+#
+
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 10))
+REPLICA_LAG_CHECK_SECONDS = 5
+PRIMARY_PIN_COOKIE = 'primary_until'
+
+routing_counts = collections.Counter()
+_replica_lag = {}  # replica index -> (lag in seconds or None, monotonic time measured)
+_routing_lock = threading.Lock()
+_next_replica = itertools.count()
+
+
+def read_only(view):
+	"""Mark a view as safe to serve from a read replica"""
+	view.read_only = True
+	return view
+
+
+def _count_route(target, reason):
+	with _routing_lock:
+		routing_counts[(target, reason)] += 1
+
+
+def replica_lag(index):
+	"""Replication lag of a replica in seconds (None if unreachable), cached briefly"""
+	lag, measured = _replica_lag.get(index, (None, None))
+	if measured is not None and time.monotonic() - measured < REPLICA_LAG_CHECK_SECONDS:
+		return lag
+	try:
+		with replica_engines[index].connect() as conn:
+			# An idle primary sends no WAL, so a fully replayed replica counts as current
+			lag = float(conn.execute(text("""
+				SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+				            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+				       END
+			""")).scalar())
+	except Exception as e:
+		print(f"Replica {index} unavailable: {e}")
+		lag = None
+	_replica_lag[index] = (lag, time.monotonic())
+	return lag
+
+
+def connect_primary():
+	"""
+	A connection from the primary's pool. Only this wait feeds the load
+	shedder's checkout wait: replica probes and connects say nothing about
+	whether the primary can take more writes.
+	"""
+	started = time.perf_counter()
+	try:
+		return engine.connect()
+	finally:
+		record_checkout_wait(time.perf_counter() - started)
+
+
+def connect_for_request():
+	"""Open the connection for this request on a replica or on the primary"""
+	view = app.view_functions.get(request.endpoint)
+	if not replica_engines or request.method not in ('GET', 'HEAD') or not getattr(view, 'read_only', False):
+		_count_route('primary', 'write')
+		return connect_primary()
+	if request.cookies.get(PRIMARY_PIN_COOKIE, 0, type=float) > time.time():
+		_count_route('primary', 'pinned')
+		return connect_primary()
+	
+	# Round-robin over the replicas, skipping lagging or unreachable ones
+	start = next(_next_replica)
+	for offset in range(len(replica_engines)):
+		index = (start + offset) % len(replica_engines)
+		lag = replica_lag(index)
+		if lag is None or lag > REPLICA_MAX_LAG_SECONDS:
+			continue
+		try:
+			conn = replica_engines[index].connect()
+		except Exception as e:
+			print(f"Replica {index} unavailable: {e}")
+			_replica_lag[index] = (None, time.monotonic())
+			continue
+		_count_route(f'replica{index}', 'read')
+		return conn
+	_count_route('primary', 'replicas_unavailable')
+	return connect_primary()
+
+
+@app.after_request
+def pin_reads_after_write(response):
+	"""Send this client's reads to the primary for a moment after it wrote something"""
+	if replica_engines and request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+		response.set_cookie(PRIMARY_PIN_COOKIE, str(time.time() + READ_YOUR_WRITES_SECONDS),
+			max_age=int(READ_YOUR_WRITES_SECONDS) + 1, httponly=True, samesite='Lax')
+	return response
+
+
+@app.route('/metrics')
+def metrics():
+	"""
+	Database routing counters, refused requests, checkout wait and replica
+	lag in Prometheus text format
+	"""
+	lines = ['# TYPE db_route_total counter']
+	with _routing_lock:
+		counts = sorted(routing_counts.items())
+	for (target, reason), count in counts:
+		lines.append(f'db_route_total{{target="{target}",reason="{reason}"}} {count}')
+	lines.append('# TYPE http_requests_refused_total counter')
+	with _routing_lock:
+		refused = sorted(shed_counts.items())
+	for reason, count in refused:
+		lines.append(f'http_requests_refused_total{{reason="{reason}"}} {count}')
+	lines.append('# TYPE db_checkout_wait_seconds gauge')
+	lines.append(f'db_checkout_wait_seconds {recent_checkout_wait():.3f}')
+	lines.append('# TYPE db_replica_lag_seconds gauge')
+	lines.append('# TYPE db_replica_up gauge')
+	for index in range(len(replica_engines)):
+		lag = replica_lag(index)
+		lines.append(f'db_replica_up{{replica="replica{index}"}} {0 if lag is None else 1}')
+		if lag is not None:
+			lines.append(f'db_replica_lag_seconds{{replica="replica{index}"}} {lag:.3f}')
+	return Response("\n".join(lines) + "\n", mimetype='text/plain')
+
+
+#
+# RATE LIMITING AND LOAD SHEDDING
+#
+# Views marked @rate_limited (the write endpoints) take a token from the
+# client address's bucket and, when the form names a user, from that user's
+# bucket: RATE_LIMIT_PER_MINUTE requests with bursts of RATE_LIMIT_BURST,
+# 429 when a bucket is empty. Buckets live in this process, or in Redis when
+# RATE_LIMIT_REDIS_URL is set so every worker shares them.
+#
+# Writes also need one of WRITE_CONCURRENCY slots (by default the pool size
+# plus overflow) to get a connection. A write that cannot get a slot within
+# LOAD_SHED_WAIT_SECONDS, that arrives while recent checkouts from the
+# primary's pool have been taking longer than that, or whose checkout times
+# out is answered with 503 and Retry-After instead of queueing until every
+# worker is stuck waiting.
+#
+
+RATE_LIMIT_PER_MINUTE = float(os.environ.get('RATE_LIMIT_PER_MINUTE', 60))
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 20))
+LOAD_SHED_WAIT_SECONDS = float(os.environ.get('LOAD_SHED_WAIT_SECONDS', 0.5))
+LOAD_SHED_RETRY_AFTER = 2
+CHECKOUT_WAIT_HALF_LIFE = 2.0
+
+rate_limiter = make_rate_limit_backend(os.environ.get('RATE_LIMIT_REDIS_URL'))
+shed_counts = collections.Counter()
+_checkout_wait = [0.0, time.monotonic()]  # decaying max of recent checkout waits, when updated
+_write_slots = None
+
+
+def rate_limited(view):
+	"""Mark a view as a write that is rate limited and load shed"""
+	view.rate_limited = True
+	return view
+
+
+def resize_write_slots(slots):
+	global _write_slots
+	_write_slots = threading.BoundedSemaphore(int(os.environ.get('WRITE_CONCURRENCY', slots)))
+
+
+resize_write_slots(int(os.environ.get('DB_POOL_SIZE', 5)) + int(os.environ.get('DB_MAX_OVERFLOW', 10)))
+
+
+def recent_checkout_wait():
+	"""Longest recent connection checkout wait, halving every CHECKOUT_WAIT_HALF_LIFE seconds"""
+	wait, updated = _checkout_wait
+	return wait * 0.5 ** ((time.monotonic() - updated) / CHECKOUT_WAIT_HALF_LIFE)
+
+
+def record_checkout_wait(seconds):
+	_checkout_wait[:] = [max(seconds, recent_checkout_wait()), time.monotonic()]
+
+
+def shed_request(reason, retry_after=LOAD_SHED_RETRY_AFTER):
+	with _routing_lock:
+		shed_counts[reason] += 1
+	return Response("Server is busy, please try again shortly", 503,
+		{'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+
+def admit_request():
+	"""
+	None when this request may go ahead, else the 429 or 503 response
+	refusing it. An admitted write holds a write slot until teardown.
+	"""
+	view = app.view_functions.get(request.endpoint)
+	if not getattr(view, 'rate_limited', False):
+		return None
+	
+	keys = [f"ip:{request.remote_addr}"]
+	if request.form.get('user_id'):
+		keys.append(f"user:{request.form['user_id']}")
+	for key in keys:
+		try:
+			allowed, retry_after = rate_limiter.take(key, RATE_LIMIT_PER_MINUTE / 60, RATE_LIMIT_BURST)
+		except Exception as e:
+			# A shared store that is down must not take the writes down with it
+			print(f"Rate limiter unavailable: {e}")
+			break
+		if not allowed:
+			with _routing_lock:
+				shed_counts['rate_limited'] += 1
+			return Response("Too many requests, please slow down", 429,
+				{'Retry-After': str(max(1, math.ceil(retry_after)))})
+	
+	if recent_checkout_wait() > LOAD_SHED_WAIT_SECONDS:
+		return shed_request('checkout_wait')
+	if not _write_slots.acquire(timeout=LOAD_SHED_WAIT_SECONDS):
+		return shed_request('write_slots')
+	g.write_slot = _write_slots
+	return None
+
+
+def release_write_slot():
+	slots = g.pop('write_slot', None)
+	if slots is not None:
+		slots.release()
+
+
+#
+# REQUEST PROFILING
+#
+# A request is profiled when it carries PROFILE_TOKEN in an X-Profile header
+# or a ?profile= parameter, and a random PROFILE_SAMPLE_RATE share of all
+# requests is profiled as well. A sampling profiler records the request's
+# stack every PROFILE_INTERVAL_MS from before_request to teardown_request,
+# so database checkout, SQL, template rendering and compression are all in
+# it, and the collapsed stacks are appended per route under PROFILE_DIR.
+# /admin/profiles (also behind PROFILE_TOKEN) shows them as flame graphs.
+#
+
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+
+request_profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+profile_store = ProfileStore(PROFILE_DIR)
+
+
+def profile_authorized():
+	"""Whether the request carries PROFILE_TOKEN"""
+	supplied = request.headers.get('X-Profile') or request.args.get('profile')
+	# Compared as bytes: compare_digest refuses str with non-ASCII characters
+	return bool(PROFILE_TOKEN and supplied) and hmac.compare_digest(supplied.encode(), PROFILE_TOKEN.encode())
+
+
+def start_profile():
+	if request.endpoint in (None, 'static') or request.endpoint.startswith('admin_profile'):
+		return
+	if profile_authorized() or random.random() < PROFILE_SAMPLE_RATE:
+		g.profile_started = time.perf_counter()
+		request_profiler.start()
+
+
+def finish_profile():
+	started = g.pop('profile_started', None)
+	if started is None:
+		return
+	samples = request_profiler.stop()
+	try:
+		profile_store.add(request.endpoint, samples, time.perf_counter() - started)
+	except OSError as e:
+		print(f"Could not store profile: {e}")
+
+
+@app.route('/admin/profiles')
+def admin_profiles():
+	"""
+	Profiled routes with their request counts and where their time went
+	"""
+	if not profile_authorized():
+		abort(404)
+	routes = []
+	for route in profile_store.routes():
+		requests, total_ms, stacks = profile_store.load(route)
+		routes.append({
+			'name': route,
+			'requests': requests,
+			'mean_ms': total_ms / requests if requests else 0,
+			'samples': sum(stacks.values()),
+			'breakdown': time_breakdown(stacks)
+		})
+	routes.sort(key=lambda route: -route['mean_ms'] * route['requests'])
+	return render_template("admin_profiles.html", routes=routes, token=request.args.get('profile'))
+
+
+@app.route('/admin/profiles/<route>')
+def admin_profile(route):
+	"""
+	Flame graph of all samples of one route (?format=folded for the raw stacks)
+	"""
+	if not profile_authorized():
+		abort(404)
+	requests, total_ms, stacks = profile_store.load(route)
+	if not requests:
+		abort(404)
+	if request.args.get('format') == 'folded':
+		return Response("".join(f"{stack} {count}\n" for stack, count in stacks.items()), mimetype='text/plain')
+	boxes = flame_graph(stacks)
+	return render_template("admin_profile.html",
+		route=route,
+		requests=requests,
+		mean_ms=total_ms / requests,
+		samples=sum(stacks.values()),
+		breakdown=time_breakdown(stacks),
+		boxes=[(depth, left, width, frame, count, frame_kind(frame)) for depth, left, width, frame, count in boxes],
+		depth=max(box[0] for box in boxes) + 1 if boxes else 0,
+		token=request.args.get('profile'))
+
+
+@app.route('/admin/profiles/<route>/clear', methods=['POST'])
+def admin_profile_clear(route):
+	"""
+	Forget the samples of one route
+	"""
+	if not profile_authorized():
+		abort(404)
+	profile_store.clear(route)
+	return redirect(f"/admin/profiles?profile={request.args.get('profile', '')}")
+
+
+#
+# RESPONSE COMPRESSION AND STATIC ASSETS
+#
+# HTML pages are whitespace-minified and every compressible response is
+# brotli- or gzip-encoded according to Accept-Encoding. The Tailwind
+# stylesheet is built ahead of time by `flask --app server build-assets`
+# into static/dist/ as a purged, content-hashed file with precompressed
+# .br/.gz siblings, served from /assets/ with far-future cache headers.
+# Until it has been built, layout.html falls back to the Tailwind CDN.
+#
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+ASSET_DIR = os.path.join(STATIC_DIR, 'dist')
+ASSET_MANIFEST = os.path.join(ASSET_DIR, 'manifest.json')
+ASSET_MAX_AGE = 365 * 24 * 3600
+COMPRESS_MIN_BYTES = 500
+COMPRESSIBLE_TYPES = {'text/html', 'text/css', 'text/plain', 'text/csv', 'application/json', 'application/javascript', 'image/svg+xml'}
+
+# Runs of whitespace containing a line break, outside <pre>, <textarea>,
+# <script> and elements styled whitespace-pre* / whitespace-break-spaces
+# (such as the notes on episode_detail.html), which display whitespace as is.
+# A preserved element ends at its first closing tag, so do not nest an
+# element of the same name inside one.
+_HTML_MINIFY = re.compile(
+	r'(<(pre|textarea|script)\b.*?</\2>'
+	r'|<(\w+)\b[^>]*\bwhitespace-(?:pre|break-spaces)\b[^>]*>.*?</\3>)'
+	r'|\s*\n\s*', re.IGNORECASE | re.DOTALL)
+
+
+def _load_asset_manifest():
+	"""Logical asset name -> fingerprinted file name, from the last build-assets run"""
+	try:
+		with open(ASSET_MANIFEST) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+
+asset_manifest = _load_asset_manifest()
+
+
+@app.context_processor
+def asset_helpers():
+	def asset_url(name):
+		fingerprinted = asset_manifest.get(name)
+		return f"/assets/{fingerprinted}" if fingerprinted else None
+	return {'asset_url': asset_url}
+
+
+def minify_html(html):
+	"""
+	Collapse indentation and blank lines where HTML folds whitespace anyway;
+	preserved elements (see _HTML_MINIFY) are copied unchanged
+	"""
+	return _HTML_MINIFY.sub(lambda match: match.group(1) or '\n', html)
+
+
+def _accepted_encodings():
+	return {value for value, quality in request.accept_encodings if quality > 0}
+
+
+@app.after_request
+def compress_response(response):
+	"""
+	Minify HTML and compress text responses with the best encoding the client accepts.
+	Streamed (SSE) and file responses are left alone; prebuilt assets come precompressed.
+	"""
+	if (response.direct_passthrough or response.is_streamed
+			or response.status_code < 200 or response.status_code in (204, 304)
+			or 'Content-Encoding' in response.headers
+			or response.mimetype not in COMPRESSIBLE_TYPES):
+		return response
+	
+	if response.mimetype == 'text/html':
+		response.set_data(minify_html(response.get_data(as_text=True)))
+	
+	response.vary.add('Accept-Encoding')
+	data = response.get_data()
+	if len(data) < COMPRESS_MIN_BYTES:
+		return response
+	encodings = _accepted_encodings()
+	if brotli is not None and 'br' in encodings:
+		response.set_data(brotli.compress(data, quality=5))
+		response.headers['Content-Encoding'] = 'br'
+	elif 'gzip' in encodings:
+		response.set_data(gzip.compress(data, compresslevel=6))
+		response.headers['Content-Encoding'] = 'gzip'
+	return response
+
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+	"""
+	Fingerprinted build output; names change with content, so it can be cached forever
+	"""
+	encodings = _accepted_encodings()
+	mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+	for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+		if encoding in encodings and os.path.isfile(os.path.join(ASSET_DIR, filename + suffix)):
+			response = send_from_directory(ASSET_DIR, filename + suffix, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+			response.headers['Content-Encoding'] = encoding
+			break
+	else:
+		response = send_from_directory(ASSET_DIR, filename, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+	response.vary.add('Accept-Encoding')
+	response.cache_control.public = True
+	response.cache_control.immutable = True
+	return response
+
+
+@app.cli.command('build-assets')
+def build_assets():
+	"""
+	Build the purged, minified Tailwind stylesheet into static/dist/.
+	Uses the Tailwind CLI from $TAILWIND_CLI (default: npx tailwindcss@3).
+	"""
+	root = os.path.dirname(os.path.abspath(__file__))
+	os.makedirs(ASSET_DIR, exist_ok=True)
+	built = os.path.join(ASSET_DIR, 'app.build.css')
+	command = shlex.split(os.environ.get('TAILWIND_CLI', 'npx tailwindcss@3')) + [
+		'-c', os.path.join(root, 'tailwind.config.js'),
+		'-i', os.path.join(STATIC_DIR, 'src', 'app.css'),
+		'-o', built,
+		'--minify'
+	]
+	subprocess.run(command, check=True, cwd=root)
+	
+	with open(built, 'rb') as f:
+		css = f.read()
+	os.remove(built)
+	name = f"app.{hashlib.sha256(css).hexdigest()[:12]}.css"
+	with open(os.path.join(ASSET_DIR, name), 'wb') as f:
+		f.write(css)
+	with open(os.path.join(ASSET_DIR, name + '.gz'), 'wb') as f:
+		f.write(gzip.compress(css, compresslevel=9))
+	if brotli is not None:
+		with open(os.path.join(ASSET_DIR, name + '.br'), 'wb') as f:
+			f.write(brotli.compress(css, quality=11))
+	
+	with open(ASSET_MANIFEST, 'w') as f:
+		json.dump({'app.css': name}, f, indent=2)
+	print(f"built {name} ({len(css)} bytes)")
+
+
+#
+# REFERENCE DATA CACHE
+#
+# The episode form needs every attack type, pain location, symptom, trigger
+# and medication. Those tables change rarely, so each process keeps one copy
+# for REFERENCE_CACHE_SECONDS. Reference writes in this process drop it at
+# once (via record_changes); other workers pick changes up on expiry.
+#
+
+REFERENCE_CACHE_SECONDS = float(os.environ.get('REFERENCE_CACHE_SECONDS', 60))
+REFERENCE_QUERIES = {
+	'attack_types': "SELECT id, name FROM pp2965.attack_types ORDER BY name",
+	'pain_locations': "SELECT id, name FROM pp2965.pain_locations ORDER BY name",
+	'symptoms': "SELECT id, name FROM pp2965.symptoms ORDER BY name",
+	'triggers': "SELECT id, name FROM pp2965.triggers ORDER BY name",
+	'medications': "SELECT id, generic_name, milligrams FROM pp2965.medications ORDER BY generic_name"
+}
+_reference_cache = {'data': None, 'expires': 0.0, 'generation': 0}
+_reference_lock = threading.Lock()
+
+
+def reference_data(conn):
+	"""Rows of every reference table keyed like REFERENCE_QUERIES (shared, do not mutate)"""
+	cache = _reference_cache
+	if cache['data'] is not None and time.monotonic() < cache['expires']:
+		return cache['data']
+	with _reference_lock:
+		if cache['data'] is None or time.monotonic() >= cache['expires']:
+			generation = cache['generation']
+			data = {name: conn.execute(text(query)).fetchall() for name, query in REFERENCE_QUERIES.items()}
+			if cache['generation'] != generation:
+				# Invalidated while loading: the rows may predate that write
+				return data
+			cache['data'], cache['expires'] = data, time.monotonic() + REFERENCE_CACHE_SECONDS
+		return cache['data']
+
+
+def invalidate_reference_data():
+	_reference_cache['generation'] += 1
+	_reference_cache['data'] = None
+
+
+def reference_ids(conn):
+	"""{table: frozenset of ids} of the cached reference data"""
+	data = reference_data(conn)
+	ids = _reference_cache.get('ids')
+	if ids is None or ids[0] is not data:
+		ids = (data, {name: frozenset(row[0] for row in rows) for name, rows in data.items()})
+		_reference_cache['ids'] = ids
+	return ids[1]
+
+
+def validate_with_references(conn, schema, items):
+	"""
+	Validate each of items with schema against the cached reference ids and
+	return their values. An id missing from the cache may have been created
+	since it was loaded (by another worker), so on unknown ids the cache is
+	reloaded once and validation repeated. Raises ValidationError with the
+	errors of all items, prefixed with their index if there are several.
+	"""
+	for attempt in range(2):
+		try:
+			return schema.validate_all(items, reference_ids(conn))
+		except ValidationError as e:
+			if not e.unknown_ids or attempt:
+				raise
+		invalidate_reference_data()
+
+
+#
+# WARM-UP
+#
+# With WARM_UP=1 the process compiles every template (filling the bytecode
+# cache) and loads the reference data cache before serving, so the first
+# requests after a deploy are not the slow ones. `flask --app server warm-up`
+# does the same on demand and prints the startup profile.
+#
+
+def warm_up():
+	"""Precompile all templates and preload the reference data cache"""
+	started = time.perf_counter()
+	for name in app.jinja_env.list_templates():
+		app.jinja_env.get_template(name)
+	record_startup('compile templates', started)
+	
+	started = time.perf_counter()
+	with engine.connect() as conn:
+		reference_data(conn)
+	record_startup('load reference data', started)
+
+
+def startup_report():
+	"""Startup profile as text, one phase per line"""
+	lines = [f"{phase:<28}{ms:10.1f} ms" for phase, ms in startup_timings]
+	lines.append(f"{'total':<28}{sum(ms for _, ms in startup_timings):10.1f} ms")
+	return "\n".join(lines)
+
+
+@app.cli.command('warm-up')
+def warm_up_command():
+	"""Precompile templates, load caches and print the startup profile"""
+	warm_up()
+	print(startup_report())
+	print("(python -X importtime breaks the imports phase down per module)")
 
 
 #
@@ -101,6 +911,7 @@ def teardown_request(exception):
 # see for decorators: http://simeonfranklin.com/blog/2012/jul/1/python-decorators-in-12-steps/
 #
 @app.route('/')
+@read_only
 def index():
 	"""
 	Home page with migraine episode statistics
@@ -160,6 +971,7 @@ def another():
 
 # Example of adding new data to the database
 @app.route('/add', methods=['POST'])
+@rate_limited
 def add():
 	# accessing form inputs from user
 	name = request.form['name']
@@ -173,6 +985,7 @@ def add():
 
 
 @app.route('/tables')
+@read_only
 def show_tables():
 	"""
 	Shows all tables in your database
@@ -198,6 +1011,7 @@ def show_tables():
 
 
 @app.route('/describe/<table_name>')
+@read_only
 def describe_table(table_name):
 	"""
 	Shows column information for a specific table
@@ -221,6 +1035,7 @@ def describe_table(table_name):
 
 
 @app.route('/view/<table_name>')
+@read_only
 def view_table(table_name):
 	"""
 	Shows first 100 rows from a specific table
@@ -262,35 +1077,215 @@ def view_table(table_name):
 # EPISODES CRUD ROUTES
 #
 
+# (form field, junction table, id column) for each many-to-many relationship of an episode
+EPISODE_LINKS = (
+	('pain_locations', 'episode_pain_locations', 'pain_location_id'),
+	('symptoms', 'episode_symptoms', 'symptom_id'),
+	('triggers', 'episode_triggers', 'trigger_id'),
+	('medications', 'episode_medications', 'medication_id'),
+)
+
+
+class VersionConflict(Exception):
+	"""The episode was modified after the client read it"""
+
+
+class EpisodeOverlap(Exception):
+	"""The episode's time span overlaps another episode of the same user"""
+	def __init__(self, episode_id):
+		super().__init__(episode_id)
+		self.episode_id = episode_id
+
+
+EPISODE_FIELDS = ('start_time', 'end_time', 'intensity', 'attack_type_id', 'had_menses', 'notes')
+
+
+def _split_episode(values):
+	"""Validated episode values as (column values, relationship ids keyed like EPISODE_LINKS)"""
+	return ({column: values[column] for column in EPISODE_FIELDS},
+		{field: values[field] for field, _, _ in EPISODE_LINKS})
+
+
+def _episode_form(schema=EPISODE_FORM):
+	"""
+	Read and validate the form posted by episode_form.html with schema.
+	Returns the validated values; raises ValidationError before anything
+	is written.
+	"""
+	values, = validate_with_references(g.conn, schema, [request.form])
+	return values
+
+
+def _episode_links(conn, episode_id):
+	"""Current relationship ids of an episode, keyed like EPISODE_LINKS"""
+	return {
+		field: {row[0] for row in conn.execute(text(
+			f"SELECT {column} FROM pp2965.{table} WHERE episode_id = :id"
+		), {'id': episode_id})}
+		for field, table, column in EPISODE_LINKS
+	}
+
+
+def _replace_episode_links(conn, episodes):
+	"""
+	Make the junction rows of episodes, {episode_id: (start_time, links)},
+	match their links. Only rows that actually changed are deleted or
+	inserted, with one statement of each kind per junction table.
+	"""
+	if not episodes:
+		return
+	for field, table, column in EPISODE_LINKS:
+		wanted = [(episode_id, ref_id, start_time) for episode_id, (start_time, links) in episodes.items()
+			for ref_id in sorted(set(links.get(field, ())))]
+		episode_ids, ref_ids, start_times = (list(values) for values in zip(*wanted)) if wanted else ([], [], [])
+		params = {'ids': sorted(episodes), 'episode_ids': episode_ids, 'ref_ids': ref_ids, 'start_times': start_times}
+		conn.execute(text(f"""
+			DELETE FROM pp2965.{table} t
+			WHERE t.episode_id = ANY(CAST(:ids AS integer[])) AND NOT EXISTS (
+				SELECT 1 FROM unnest(CAST(:episode_ids AS integer[]), CAST(:ref_ids AS integer[])) AS w(episode_id, ref_id)
+				WHERE w.episode_id = t.episode_id AND w.ref_id = t.{column}
+			)
+		"""), params)
+		if wanted:
+			conn.execute(text(f"""
+				INSERT INTO pp2965.{table} (episode_id, {column}, episode_start_time)
+				SELECT w.episode_id, w.ref_id, w.start_time
+				FROM unnest(CAST(:episode_ids AS integer[]), CAST(:ref_ids AS integer[]),
+				            CAST(:start_times AS {EPISODE_TIME_TYPE}[])) AS w(episode_id, ref_id, start_time)
+				WHERE NOT EXISTS (
+					SELECT 1 FROM pp2965.{table} WHERE episode_id = w.episode_id AND {column} = w.ref_id
+				)
+			"""), params)
+
+
+def create_episode(conn, user_id, fields, links, idempotency_key=None):
+	"""
+	Insert an episode and its relationships (caller commits).
+	Returns (episode_id, created); when idempotency_key was already used by this
+	user the existing episode id is returned and nothing is written. With
+	EPISODE_NO_OVERLAP, raises EpisodeOverlap if the user already has an
+	episode overlapping this one.
+	"""
+	overlap_check = f"""
+		WHERE NOT EXISTS (
+			SELECT 1 FROM pp2965.episodes other
+			WHERE other.user_id = :user_id AND {_overlap_sql('other', ':start_time', ':end_time')}
+		)""" if EPISODE_NO_OVERLAP else ''
+	row = conn.execute(text(f"""
+		INSERT INTO pp2965.episodes 
+		(user_id, start_time, end_time, intensity, attack_type_id, had_menses, notes,
+		 created_at, updated_at, idempotency_key)
+		SELECT :user_id, :start_time, :end_time, :intensity, :attack_type_id, :had_menses, :notes,
+		       NOW(), NOW(), :idempotency_key{overlap_check}
+		ON CONFLICT DO NOTHING
+		RETURNING id, start_time, end_time
+	"""), {**fields, 'user_id': user_id, 'idempotency_key': idempotency_key}).fetchone()
+	
+	if row is None:
+		existing = conn.execute(text(
+			"SELECT id FROM pp2965.episodes WHERE user_id = :user_id AND idempotency_key = :key"
+		), {'user_id': user_id, 'key': idempotency_key}).fetchone()
+		if existing is not None:
+			return existing[0], False
+		overlap = overlapping_episode(conn, user_id, fields['start_time'], fields['end_time'])
+		if overlap is not None:
+			raise EpisodeOverlap(overlap)
+		raise ValueError("episode could not be inserted")
+	
+	episode_id, start_time, end_time = row
+	_replace_episode_links(conn, {episode_id: (start_time, links)})
+	refresh_heatmap(conn, user_id, _episode_years(start_time, end_time))
+	record_change(conn, 'episode', episode_id, 'create', user_id)
+	return episode_id, True
+
+
+def update_episode(conn, episode_id, version, fields, links, changes=None):
+	"""
+	Compare-and-swap update of an episode and its relationships (caller commits).
+	The write only happens if the stored version still equals version (None skips
+	the check). The change is recorded in the feed, or appended to changes for
+	the caller to record. Returns True if the episode was written, False if the
+	version was stale but the stored episode already equals the submitted one
+	(a retried request). Raises LookupError if the episode does not exist,
+	VersionConflict if someone else changed it in between and, with
+	EPISODE_NO_OVERLAP, EpisodeOverlap if the new time span overlaps another
+	episode of the same user.
+	"""
+	old = conn.execute(text(
+		"SELECT user_id, start_time, end_time, version FROM pp2965.episodes WHERE id = :id"
+	), {'id': episode_id}).fetchone()
+	if old is None:
+		raise LookupError(episode_id)
+	
+	params = {**fields, 'id': episode_id, 'version': version}
+	# An unchanged time span is let through, even if it already overlapped
+	overlap_check = f"""
+		  AND (active_range = {_range_sql(':start_time', ':end_time')} OR NOT EXISTS (
+			SELECT 1 FROM pp2965.episodes other
+			WHERE other.user_id = episodes.user_id AND other.id <> :id
+			  AND {_overlap_sql('other', ':start_time', ':end_time')}
+		  ))""" if EPISODE_NO_OVERLAP else ''
+	row = conn.execute(text(f"""
+		UPDATE pp2965.episodes 
+		SET start_time = :start_time,
+		    end_time = :end_time,
+		    intensity = :intensity,
+		    attack_type_id = :attack_type_id,
+		    had_menses = :had_menses,
+		    notes = :notes,
+		    version = version + 1,
+		    updated_at = NOW()
+		WHERE id = :id AND (:version IS NULL OR version = :version){overlap_check}
+		RETURNING start_time, end_time
+	"""), params).fetchone()
+	
+	if row is None:
+		unchanged = conn.execute(text("""
+			SELECT 1 FROM pp2965.episodes
+			WHERE id = :id
+			  AND start_time IS NOT DISTINCT FROM :start_time
+			  AND end_time IS NOT DISTINCT FROM :end_time
+			  AND intensity IS NOT DISTINCT FROM :intensity
+			  AND attack_type_id IS NOT DISTINCT FROM :attack_type_id
+			  AND had_menses IS NOT DISTINCT FROM :had_menses
+			  AND notes IS NOT DISTINCT FROM :notes
+		"""), params).fetchone()
+		wanted = {field: set(links.get(field, ())) for field, _, _ in EPISODE_LINKS}
+		if unchanged is not None and _episode_links(conn, episode_id) == wanted:
+			return False
+		if EPISODE_NO_OVERLAP and (version is None or old[3] == version):
+			overlap = overlapping_episode(conn, old[0], fields['start_time'], fields['end_time'], episode_id)
+			if overlap is not None:
+				raise EpisodeOverlap(overlap)
+		raise VersionConflict(episode_id)
+	
+	# On a partitioned table, moving an episode to another month's partition
+	# deletes its links (before PostgreSQL 15), so this puts them back too
+	_replace_episode_links(conn, {episode_id: (row[0], links)})
+	
+	# Recompute the calendar days of both the old and the new time span
+	years = _episode_years(old[1], old[2]) | _episode_years(row[0], row[1])
+	refresh_heatmap(conn, old[0], years)
+	if changes is None:
+		record_change(conn, 'episode', episode_id, 'update', old[0])
+	else:
+		changes.append(('episode', episode_id, 'update', old[0]))
+	return True
+
+
 # List all episodes
 @app.route('/episodes')
+@read_only
 def episodes_list():
 	"""
 	Display all episodes for the logged-in user
 	"""
 	try:
-		query = """
-			SELECT id, user_id, start_time, end_time, 
-			       intensity, attack_type_id, had_menses, notes, created_at
-			FROM pp2965.episodes
-			ORDER BY start_time DESC
-			LIMIT 100
-		"""
-		cursor = g.conn.execute(text(query))
-		episodes = []
-		for row in cursor:
-			episodes.append({
-				'id': row[0],
-				'user_id': row[1],
-				'start_time': row[2],
-				'end_time': row[3],
-				'intensity': row[4],
-				'attack_type_id': row[5],
-				'had_menses': row[6],
-				'notes': row[7],
-				'created_at': row[8]
-			})
-		cursor.close()
+		# Episodes are built lazily while the template iterates; peek at the
+		# first one so the template can still tell an empty list apart
+		episodes = recent_episodes(g.conn, 100)
+		first = next(episodes, None)
+		episodes = itertools.chain([first], episodes) if first is not None else []
 		return render_template('episodes_list.html', episodes=episodes)
 	except Exception as e:
 		return f"Error loading episodes: {str(e)}", 500
@@ -303,21 +1298,14 @@ def episode_new():
 	Display form to create a new episode
 	"""
 	try:
-		# Fetch all reference data for dropdowns
-		attack_types = g.conn.execute(text("SELECT id, name FROM pp2965.attack_types ORDER BY name")).fetchall()
-		pain_locations = g.conn.execute(text("SELECT id, name FROM pp2965.pain_locations ORDER BY name")).fetchall()
-		symptoms = g.conn.execute(text("SELECT id, name FROM pp2965.symptoms ORDER BY name")).fetchall()
-		triggers = g.conn.execute(text("SELECT id, name FROM pp2965.triggers ORDER BY name")).fetchall()
-		medications = g.conn.execute(text("SELECT id, generic_name, milligrams FROM pp2965.medications ORDER BY generic_name")).fetchall()
+		# Reference data for dropdowns (cached, see REFERENCE DATA CACHE)
+		options = reference_data(g.conn)
 		
 		return render_template('episode_form.html', 
 			episode=None, 
 			action='create',
-			attack_types=attack_types,
-			pain_locations=pain_locations,
-			symptoms=symptoms,
-			triggers=triggers,
-			medications=medications,
+			idempotency_key=uuid.uuid4().hex,
+			**options,
 			selected_pain_locations=[],
 			selected_symptoms=[],
 			selected_triggers=[],
@@ -328,122 +1316,55 @@ def episode_new():
 
 # Handle create episode form submission
 @app.route('/episodes/create', methods=['POST'])
+@rate_limited
 def episode_create():
 	"""
 	Create a new episode
 	"""
 	try:
 		# Get form data
-		user_id = request.form.get('user_id', 1)  # Default to user 1 for now
-		start_datetime = request.form['start_datetime']
-		end_datetime = request.form.get('end_datetime', None)
-		intensity = request.form['intensity']
-		attack_type_id = request.form.get('attack_type_id', None)
-		had_menses = request.form.get('had_menses') == 'on'
-		notes = request.form.get('notes', '')
-		
-		# Get multi-select values (getlist returns all selected values)
-		pain_location_ids = request.form.getlist('pain_locations')
-		symptom_ids = request.form.getlist('symptoms')
-		trigger_ids = request.form.getlist('triggers')
-		medication_ids = request.form.getlist('medications')
-		
-		# Validate: end time must be after start time
-		if end_datetime and end_datetime < start_datetime:
-			return "Error: End time must be after start time!", 400
-		
-		# Insert episode and get the new ID
-		query = """
-			INSERT INTO pp2965.episodes 
-			(user_id, start_time, end_time, intensity, attack_type_id, had_menses, notes, created_at)
-			VALUES (:user_id, :start_time, :end_time, :intensity, :attack_type_id, :had_menses, :notes, NOW())
-			RETURNING id
-		"""
-		params = {
-			'user_id': user_id,
-			'start_time': start_datetime,
-			'end_time': end_datetime if end_datetime else None,
-			'intensity': intensity,
-			'attack_type_id': attack_type_id if attack_type_id else None,
-			'had_menses': had_menses,
-			'notes': notes
-		}
-		result = g.conn.execute(text(query), params)
-		episode_id = result.fetchone()[0]
-		
-		# Insert pain location relationships
-		for location_id in pain_location_ids:
-			g.conn.execute(text("""
-				INSERT INTO pp2965.episode_pain_locations (episode_id, pain_location_id)
-				VALUES (:episode_id, :location_id)
-			"""), {'episode_id': episode_id, 'location_id': location_id})
-		
-		# Insert symptom relationships
-		for symptom_id in symptom_ids:
-			g.conn.execute(text("""
-				INSERT INTO pp2965.episode_symptoms (episode_id, symptom_id)
-				VALUES (:episode_id, :symptom_id)
-			"""), {'episode_id': episode_id, 'symptom_id': symptom_id})
-		
-		# Insert trigger relationships
-		for trigger_id in trigger_ids:
-			g.conn.execute(text("""
-				INSERT INTO pp2965.episode_triggers (episode_id, trigger_id)
-				VALUES (:episode_id, :trigger_id)
-			"""), {'episode_id': episode_id, 'trigger_id': trigger_id})
-		
-		# Insert medication relationships
-		for medication_id in medication_ids:
-			g.conn.execute(text("""
-				INSERT INTO pp2965.episode_medications (episode_id, medication_id)
-				VALUES (:episode_id, :medication_id)
-			"""), {'episode_id': episode_id, 'medication_id': medication_id})
+		values = _episode_form()
+		idempotency_key = request.form.get('idempotency_key') or None
+		fields, links = _split_episode(values)
 		
+		# A double-submit with the same idempotency key just returns the first episode
+		episode_id, _ = create_episode(g.conn, values['user_id'], fields, links, idempotency_key)
 		g.conn.commit()
 		
+		overlap = episode_overlaps(g.conn, [episode_id]).get(episode_id)
+		if overlap is not None:
+			return redirect(f'/episodes/{episode_id}?overlaps={overlap}')
 		return redirect('/episodes')
+	except ValidationError as e:
+		return f"Error: {e}", 400
+	except EpisodeOverlap as e:
+		return f"Error: This episode overlaps episode {e.episode_id}. Edit that one or change the times.", 409
+	except IntegrityError as e:
+		if _is_overlap_violation(e):
+			return "Error: This episode overlaps another one. Change the times.", 409
+		return f"Error creating episode: {str(e)}", 500
 	except Exception as e:
 		return f"Error creating episode: {str(e)}", 500
 
 
 # View single episode details
 @app.route('/episodes/<int:episode_id>')
+@read_only
 def episode_detail(episode_id):
 	"""
 	Display details of a single episode
 	"""
 	try:
-		query = """
-			SELECT id, user_id, start_time, end_time, 
-			       intensity, attack_type_id, had_menses, notes, created_at
-			FROM pp2965.episodes
-			WHERE id = :id
-		"""
-		cursor = g.conn.execute(text(query), {'id': episode_id})
-		row = cursor.fetchone()
-		cursor.close()
-		
-		if row is None:
+		episode = get_episode(g.conn, episode_id)
+		if episode is None:
 			return "Episode not found", 404
 		
-		episode = {
-			'id': row[0],
-			'user_id': row[1],
-			'start_time': row[2],
-			'end_time': row[3],
-			'intensity': row[4],
-			'attack_type_id': row[5],
-			'had_menses': row[6],
-			'notes': row[7],
-			'created_at': row[8]
-		}
-		
 		# Fetch attack type name if exists
 		attack_type = None
-		if episode['attack_type_id']:
+		if episode.attack_type_id:
 			result = g.conn.execute(text(
 				"SELECT name FROM pp2965.attack_types WHERE id = :id"
-			), {'id': episode['attack_type_id']}).fetchone()
+			), {'id': episode.attack_type_id}).fetchone()
 			if result:
 				attack_type = result[0]
 		
@@ -485,6 +1406,7 @@ def episode_detail(episode_id):
 		
 		return render_template('episode_detail.html', 
 			episode=episode,
+			overlaps=request.args.get('overlaps', type=int),
 			attack_type=attack_type,
 			pain_locations=pain_locations,
 			symptoms=symptoms,
@@ -501,36 +1423,12 @@ def episode_edit(episode_id):
 	Display form to edit an existing episode
 	"""
 	try:
-		query = """
-			SELECT id, user_id, start_time, end_time, 
-			       intensity, attack_type_id, had_menses, notes
-			FROM pp2965.episodes
-			WHERE id = :id
-		"""
-		cursor = g.conn.execute(text(query), {'id': episode_id})
-		row = cursor.fetchone()
-		cursor.close()
-		
-		if row is None:
+		episode = get_episode(g.conn, episode_id)
+		if episode is None:
 			return "Episode not found", 404
 		
-		episode = {
-			'id': row[0],
-			'user_id': row[1],
-			'start_time': row[2],
-			'end_time': row[3],
-			'intensity': row[4],
-			'attack_type_id': row[5],
-			'had_menses': row[6],
-			'notes': row[7]
-		}
-		
-		# Fetch all reference data for dropdowns
-		attack_types = g.conn.execute(text("SELECT id, name FROM pp2965.attack_types ORDER BY name")).fetchall()
-		pain_locations = g.conn.execute(text("SELECT id, name FROM pp2965.pain_locations ORDER BY name")).fetchall()
-		symptoms = g.conn.execute(text("SELECT id, name FROM pp2965.symptoms ORDER BY name")).fetchall()
-		triggers = g.conn.execute(text("SELECT id, name FROM pp2965.triggers ORDER BY name")).fetchall()
-		medications = g.conn.execute(text("SELECT id, generic_name, milligrams FROM pp2965.medications ORDER BY generic_name")).fetchall()
+		# Reference data for dropdowns (cached, see REFERENCE DATA CACHE)
+		options = reference_data(g.conn)
 		
 		# Fetch existing relationships
 		selected_pain_locations = [row[0] for row in g.conn.execute(text(
@@ -552,11 +1450,7 @@ def episode_edit(episode_id):
 		return render_template('episode_form.html', 
 			episode=episode, 
 			action='update',
-			attack_types=attack_types,
-			pain_locations=pain_locations,
-			symptoms=symptoms,
-			triggers=triggers,
-			medications=medications,
+			**options,
 			selected_pain_locations=selected_pain_locations,
 			selected_symptoms=selected_symptoms,
 			selected_triggers=selected_triggers,
@@ -567,101 +1461,52 @@ def episode_edit(episode_id):
 
 # Handle update episode form submission
 @app.route('/episodes/<int:episode_id>/update', methods=['POST'])
+@rate_limited
 def episode_update(episode_id):
 	"""
 	Update an existing episode
 	"""
 	try:
-		# Get form data
-		start_datetime = request.form['start_datetime']
-		end_datetime = request.form.get('end_datetime', None)
-		intensity = request.form['intensity']
-		attack_type_id = request.form.get('attack_type_id', None)
-		had_menses = request.form.get('had_menses') == 'on'
-		notes = request.form.get('notes', '')
-		
-		# Get multi-select values
-		pain_location_ids = request.form.getlist('pain_locations')
-		symptom_ids = request.form.getlist('symptoms')
-		trigger_ids = request.form.getlist('triggers')
-		medication_ids = request.form.getlist('medications')
-		
-		# Validate: end time must be after start time
-		if end_datetime and end_datetime < start_datetime:
-			return "Error: End time must be after start time!", 400
-		
-		# Update episode
-		query = """
-			UPDATE pp2965.episodes 
-			SET start_time = :start_time,
-			    end_time = :end_time,
-			    intensity = :intensity,
-			    attack_type_id = :attack_type_id,
-			    had_menses = :had_menses,
-			    notes = :notes
-			WHERE id = :id
-		"""
-		params = {
-			'id': episode_id,
-			'start_time': start_datetime,
-			'end_time': end_datetime if end_datetime else None,
-			'intensity': intensity,
-			'attack_type_id': attack_type_id if attack_type_id else None,
-			'had_menses': had_menses,
-			'notes': notes
-		}
-		g.conn.execute(text(query), params)
-		
-		# Delete existing relationships
-		g.conn.execute(text("DELETE FROM pp2965.episode_pain_locations WHERE episode_id = :id"), {'id': episode_id})
-		g.conn.execute(text("DELETE FROM pp2965.episode_symptoms WHERE episode_id = :id"), {'id': episode_id})
-		g.conn.execute(text("DELETE FROM pp2965.episode_triggers WHERE episode_id = :id"), {'id': episode_id})
-		g.conn.execute(text("DELETE FROM pp2965.episode_medications WHERE episode_id = :id"), {'id': episode_id})
-		
-		# Insert new pain location relationships
-		for location_id in pain_location_ids:
-			g.conn.execute(text("""
-				INSERT INTO pp2965.episode_pain_locations (episode_id, pain_location_id)
-				VALUES (:episode_id, :location_id)
-			"""), {'episode_id': episode_id, 'location_id': location_id})
-		
-		# Insert new symptom relationships
-		for symptom_id in symptom_ids:
-			g.conn.execute(text("""
-				INSERT INTO pp2965.episode_symptoms (episode_id, symptom_id)
-				VALUES (:episode_id, :symptom_id)
-			"""), {'episode_id': episode_id, 'symptom_id': symptom_id})
-		
-		# Insert new trigger relationships
-		for trigger_id in trigger_ids:
-			g.conn.execute(text("""
-				INSERT INTO pp2965.episode_triggers (episode_id, trigger_id)
-				VALUES (:episode_id, :trigger_id)
-			"""), {'episode_id': episode_id, 'trigger_id': trigger_id})
-		
-		# Insert new medication relationships
-		for medication_id in medication_ids:
-			g.conn.execute(text("""
-				INSERT INTO pp2965.episode_medications (episode_id, medication_id)
-				VALUES (:episode_id, :medication_id)
-			"""), {'episode_id': episode_id, 'medication_id': medication_id})
-		
+		# Get form data; a form without a valid version is refused rather
+		# than saved without the compare-and-swap
+		values = _episode_form(EPISODE_UPDATE_FORM)
+		fields, links = _split_episode(values)
+		update_episode(g.conn, episode_id, values['version'], fields, links)
 		g.conn.commit()
 		
+		overlap = episode_overlaps(g.conn, [episode_id]).get(episode_id)
+		if overlap is not None:
+			return redirect(f'/episodes/{episode_id}?overlaps={overlap}')
 		return redirect(f'/episodes/{episode_id}')
+	except ValidationError as e:
+		return f"Error: {e}", 400
+	except LookupError:
+		return "Episode not found", 404
+	except VersionConflict:
+		return "Error: This episode was changed since you opened it. Reload the page and try again.", 409
+	except EpisodeOverlap as e:
+		return f"Error: This episode would overlap episode {e.episode_id}. Change the times.", 409
+	except IntegrityError as e:
+		if _is_overlap_violation(e):
+			return "Error: This episode would overlap another one. Change the times.", 409
+		return f"Error updating episode: {str(e)}", 500
 	except Exception as e:
 		return f"Error updating episode: {str(e)}", 500
 
 
 # Handle delete episode
 @app.route('/episodes/<int:episode_id>/delete', methods=['POST'])
+@rate_limited
 def episode_delete(episode_id):
 	"""
 	Delete an episode
 	"""
 	try:
-		query = "DELETE FROM pp2965.episodes WHERE id = :id"
-		g.conn.execute(text(query), {'id': episode_id})
+		query = "DELETE FROM pp2965.episodes WHERE id = :id RETURNING user_id, start_time, end_time"
+		row = g.conn.execute(text(query), {'id': episode_id}).fetchone()
+		if row is not None:
+			refresh_heatmap(g.conn, row[0], _episode_years(row[1], row[2]))
+			record_change(g.conn, 'episode', episode_id, 'delete', row[0])
 		g.conn.commit()
 		
 		return redirect('/episodes')
@@ -670,360 +1515,1256 @@ def episode_delete(episode_id):
 
 
 #
-# MEDICATIONS CRUD ROUTES
+# CALENDAR HEATMAP
+#
+# pp2965.episode_day_intensity holds one packed byte array per user-year,
+# indexed by day of year, with the max intensity recorded on that day.
+# Episode writes rebuild the affected years in the same transaction, so a
+# year heatmap is a single primary-key fetch.
 #
 
-@app.route('/medications')
-def medications_list():
-	"""List all medications"""
-	try:
-		query = "SELECT id, generic_name, milligrams, route FROM pp2965.medications ORDER BY generic_name"
-		medications = g.conn.execute(text(query)).fetchall()
-		return render_template('medications_list.html', medications=medications)
-	except Exception as e:
-		return f"Error loading medications: {str(e)}", 500
-
-@app.route('/medications/new')
-def medication_new():
-	"""Show form to create new medication"""
-	return render_template('medication_form.html', medication=None, action='create')
+HEATMAP_DAYS = 366
 
-@app.route('/medications/create', methods=['POST'])
-def medication_create():
-	"""Create a new medication"""
-	try:
-		generic_name = request.form['generic_name']
-		milligrams = request.form.get('milligrams', None)
-		route = request.form.get('route', '')
-		g.conn.execute(text("""
-			INSERT INTO pp2965.medications (generic_name, milligrams, route)
-			VALUES (:generic_name, :milligrams, :route)
-		"""), {'generic_name': generic_name, 'milligrams': milligrams if milligrams else None, 'route': route})
-		g.conn.commit()
-		return redirect('/medications')
-	except Exception as e:
-		return f"Error creating medication: {str(e)}", 500
 
-@app.route('/medications/<int:med_id>/edit')
-def medication_edit(med_id):
-	"""Show form to edit medication"""
-	try:
-		row = g.conn.execute(text(
-			"SELECT id, generic_name, milligrams, route FROM pp2965.medications WHERE id = :id"
-		), {'id': med_id}).fetchone()
-		if row is None:
-			return "Medication not found", 404
-		medication = {'id': row[0], 'generic_name': row[1], 'milligrams': row[2], 'route': row[3]}
-		return render_template('medication_form.html', medication=medication, action='update')
-	except Exception as e:
-		return f"Error loading medication: {str(e)}", 500
+def _episode_years(start_time, end_time):
+	"""Calendar years touched by an episode"""
+	if start_time is None:
+		return set()
+	last = end_time if end_time and end_time > start_time else start_time
+	return set(range(start_time.year, last.year + 1))
 
-@app.route('/medications/<int:med_id>/update', methods=['POST'])
-def medication_update(med_id):
-	"""Update a medication"""
-	try:
-		generic_name = request.form['generic_name']
-		milligrams = request.form.get('milligrams', None)
-		route = request.form.get('route', '')
-		g.conn.execute(text("""
-			UPDATE pp2965.medications 
-			SET generic_name = :generic_name, milligrams = :milligrams, route = :route
-			WHERE id = :id
-		"""), {'id': med_id, 'generic_name': generic_name, 'milligrams': milligrams if milligrams else None, 'route': route})
-		g.conn.commit()
-		return redirect('/medications')
-	except Exception as e:
-		return f"Error updating medication: {str(e)}", 500
 
-@app.route('/medications/<int:med_id>/delete', methods=['POST'])
-def medication_delete(med_id):
-	"""Delete a medication"""
+def refresh_heatmap(conn, user_id, years):
+	"""
+	Rebuild the day array of each given year for a user (caller commits).
+	Each user-year is locked until commit before it is recomputed, so of two
+	concurrent writes the second waits and then reads the first one's
+	episodes too, instead of overwriting its array with an older picture.
+	"""
+	for year in sorted(years):
+		# Two-key advisory locks do not share a key space with one-key ones
+		conn.execute(text("SELECT pg_advisory_xact_lock(CAST(:user_id AS integer), :year)"),
+			{'user_id': user_id, 'year': year})
+		days = bytearray(HEATMAP_DAYS)
+		rows = conn.execute(text(f"""
+			SELECT day::date, MAX(e.intensity)
+			FROM pp2965.episodes e,
+			     generate_series(date_trunc('day', e.start_time),
+			                     date_trunc('day', GREATEST(e.start_time, COALESCE(e.end_time, e.start_time))),
+			                     interval '1 day') AS day
+			WHERE e.user_id = :user_id
+			  AND e.intensity IS NOT NULL
+			  AND e.active_range && {_range_sql('make_date(:year, 1, 1)', 'make_date(:year + 1, 1, 1)')}
+			GROUP BY 1
+		"""), {'user_id': user_id, 'year': year})
+		for day, intensity in rows:
+			if day.year == year:
+				days[day.timetuple().tm_yday - 1] = max(0, min(255, int(intensity)))
+		conn.execute(text("""
+			INSERT INTO pp2965.episode_day_intensity (user_id, year, days)
+			VALUES (:user_id, :year, :days)
+			ON CONFLICT (user_id, year) DO UPDATE SET days = EXCLUDED.days
+		"""), {'user_id': user_id, 'year': year, 'days': bytes(days)})
+
+
+@app.route('/calendar/<int:year>')
+def calendar_heatmap(year):
+	"""
+	Max intensity per day of a year as JSON (days[0] is January 1st, 0 = no episode)
+	"""
+	if not 1 <= year < 9999:
+		abort(404)
+	user_id = request.args.get('user_id', 1, type=int)
+	query = "SELECT days FROM pp2965.episode_day_intensity WHERE user_id = :user_id AND year = :year"
+	params = {'user_id': user_id, 'year': year}
 	try:
-		g.conn.execute(text("DELETE FROM pp2965.medications WHERE id = :id"), {'id': med_id})
-		g.conn.commit()
-		return redirect('/medications')
+		row = g.conn.execute(text(query), params).fetchone()
+		if row is None:
+			# First request for this year: build it once, later hits are a single fetch
+			refresh_heatmap(g.conn, user_id, [year])
+			g.conn.commit()
+			row = g.conn.execute(text(query), params).fetchone()
+		
+		days = memoryview(row[0])[:366 if calendar.isleap(year) else 365]
+		return jsonify({
+			'user_id': user_id,
+			'year': year,
+			'start': date(year, 1, 1).isoformat(),
+			'days': days.tolist()
+		})
 	except Exception as e:
-		return f"Error deleting medication: {str(e)}", 500
+		return f"Error loading calendar: {str(e)}", 500
 
 
 #
-# SYMPTOMS CRUD ROUTES
+# EPISODE TIME SPANS
+#
+# episodes.active_range is a generated [start_time, end_time] range (ongoing
+# episodes have no upper bound) with a GiST index on (user_id, active_range),
+# so "which of this user's episodes touch this window" is an index lookup
+# rather than a scan of their history.
+#
+# Overlaps between a user's episodes compare spans instead, in which an
+# ongoing episode is only its start time: an episode left "Ongoing" must not
+# collide with everything recorded after it. By default an overlapping
+# episode is saved and the user is warned (the detail page, or "overlaps" in
+# the /sync response). With EPISODE_NO_OVERLAP=1 it is refused inside the
+# INSERT/UPDATE, and an exclusion constraint also refuses the second of two
+# concurrent requests that both passed that check.
 #
 
-@app.route('/symptoms')
-def symptoms_list():
-	"""List all symptoms"""
-	try:
-		query = "SELECT id, name FROM pp2965.symptoms ORDER BY name"
-		symptoms = g.conn.execute(text(query)).fetchall()
-		return render_template('symptoms_list.html', symptoms=symptoms)
-	except Exception as e:
-		return f"Error loading symptoms: {str(e)}", 500
+EPISODE_NO_OVERLAP = os.environ.get('EPISODE_NO_OVERLAP') == '1'
+EPISODE_WINDOW_OPERATORS = {'overlaps': '&&', 'within': '<@', 'contains': '@>'}
+EPISODE_WINDOW_LIMIT = 500
 
-@app.route('/symptoms/new')
-def symptom_new():
-	"""Show form to create new symptom"""
-	return render_template('symptom_form.html', symptom=None, action='create')
 
-@app.route('/symptoms/create', methods=['POST'])
-def symptom_create():
-	"""Create a new symptom"""
-	try:
-		name = request.form['name']
-		g.conn.execute(text(
-			"INSERT INTO pp2965.symptoms (name) VALUES (:name)"
-		), {'name': name})
-		g.conn.commit()
-		return redirect('/symptoms')
-	except Exception as e:
-		return f"Error creating symptom: {str(e)}", 500
+def _range_sql(start, end):
+	"""SQL for the range [start, end] of two SQL expressions (end NULL = ongoing)"""
+	return (f"{EPISODE_RANGE_TYPE}(CAST({start} AS {EPISODE_TIME_TYPE}), "
+		f"CAST({end} AS {EPISODE_TIME_TYPE}), '[]')")
 
-@app.route('/symptoms/<int:symptom_id>/edit')
-def symptom_edit(symptom_id):
-	"""Show form to edit symptom"""
-	try:
-		row = g.conn.execute(text(
-			"SELECT id, name FROM pp2965.symptoms WHERE id = :id"
-		), {'id': symptom_id}).fetchone()
-		if row is None:
-			return "Symptom not found", 404
-		symptom = {'id': row[0], 'name': row[1]}
-		return render_template('symptom_form.html', symptom=symptom, action='update')
-	except Exception as e:
-		return f"Error loading symptom: {str(e)}", 500
 
-@app.route('/symptoms/<int:symptom_id>/update', methods=['POST'])
-def symptom_update(symptom_id):
-	"""Update a symptom"""
-	try:
-		name = request.form['name']
-		g.conn.execute(text(
-			"UPDATE pp2965.symptoms SET name = :name WHERE id = :id"
-		), {'id': symptom_id, 'name': name})
-		g.conn.commit()
-		return redirect('/symptoms')
-	except Exception as e:
-		return f"Error updating symptom: {str(e)}", 500
+def _span_sql(start, end):
+	"""SQL for the span of an episode: [start, end], or just [start, start] while ongoing"""
+	start = f"CAST({start} AS {EPISODE_TIME_TYPE})"
+	return f"{EPISODE_RANGE_TYPE}({start}, GREATEST({start}, CAST({end} AS {EPISODE_TIME_TYPE})), '[]')"
+
 
-@app.route('/symptoms/<int:symptom_id>/delete', methods=['POST'])
-def symptom_delete(symptom_id):
-	"""Delete a symptom"""
+def _overlap_sql(other, start, end, active_range=None):
+	"""
+	SQL condition: the episode aliased other overlaps the span of [start, end].
+	The test on active_range (by default the range of [start, end]) is implied
+	by the span test but can use the index.
+	"""
+	return (f"{other}.active_range && {active_range or _range_sql(start, end)} "
+		f"AND {_span_sql(f'{other}.start_time', f'{other}.end_time')} && {_span_sql(start, end)}")
+
+
+def _is_overlap_violation(error):
+	"""Whether an IntegrityError comes from the episodes_no_overlap constraint"""
+	return getattr(error.orig, 'pgcode', None) == '23P01'
+
+
+def overlapping_episode(conn, user_id, start_time, end_time, exclude_id=None):
+	"""Id of the user's earliest episode overlapping the span of [start_time, end_time], or None"""
+	return conn.execute(text(f"""
+		SELECT id FROM pp2965.episodes other
+		WHERE user_id = :user_id
+		  AND {_overlap_sql('other', ':start_time', ':end_time')}
+		  AND id IS DISTINCT FROM :exclude_id
+		ORDER BY start_time
+		LIMIT 1
+	"""), {'user_id': user_id, 'start_time': start_time, 'end_time': end_time,
+		'exclude_id': exclude_id}).scalar()
+
+
+def episode_overlaps(conn, episode_ids):
+	"""{episode id: the earliest other episode of its user it overlaps} for those that overlap one"""
+	if not episode_ids:
+		return {}
+	return dict(conn.execute(text(f"""
+		SELECT id, overlap FROM (
+			SELECT e.id, (
+				SELECT other.id FROM pp2965.episodes other
+				WHERE other.user_id = e.user_id AND other.id <> e.id
+				  AND {_overlap_sql('other', 'e.start_time', 'e.end_time', 'e.active_range')}
+				ORDER BY other.start_time
+				LIMIT 1
+			) AS overlap
+			FROM pp2965.episodes e
+			WHERE e.id = ANY(CAST(:ids AS integer[]))
+		) overlaps
+		WHERE overlap IS NOT NULL
+	"""), {'ids': sorted(set(episode_ids))}).fetchall())
+
+
+def episodes_in_window(conn, user_id, start, end=None, mode='overlaps', limit=EPISODE_WINDOW_LIMIT):
+	"""
+	A user's episodes by how their time span relates to the window [start, end]
+	(end None = open ended), oldest first: 'overlaps' (active at some point in
+	the window), 'within' (entirely inside it) or 'contains' (active all of it)
+	"""
+	return iter_episodes(conn.execute(text(f"""
+		SELECT {EPISODE_COLUMNS}
+		FROM pp2965.episodes
+		WHERE user_id = :user_id
+		  AND active_range {EPISODE_WINDOW_OPERATORS[mode]} {_range_sql(':start', ':end')}
+		ORDER BY start_time
+		LIMIT :limit
+	"""), {'user_id': user_id, 'start': start, 'end': end, 'limit': limit}))
+
+
+@app.route('/episodes/window')
+@read_only
+def episodes_window():
+	"""
+	A user's episodes relative to a time window as JSON:
+	?start=<ISO time>&end=<ISO time, optional>&mode=overlaps|within|contains
+	"""
+	user_id = request.args.get('user_id', 1, type=int)
+	mode = request.args.get('mode', 'overlaps')
+	if mode not in EPISODE_WINDOW_OPERATORS:
+		return f"Error: mode must be one of {', '.join(EPISODE_WINDOW_OPERATORS)}", 400
 	try:
-		g.conn.execute(text("DELETE FROM pp2965.symptoms WHERE id = :id"), {'id': symptom_id})
-		g.conn.commit()
-		return redirect('/symptoms')
+		start = datetime.fromisoformat(request.args['start'])
+		end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else None
+	except (KeyError, ValueError) as e:
+		return f"Error: start (and optionally end) must be ISO 8601 times: {str(e)}", 400
+	if end is not None and end < start:
+		return "Error: end must not be before start", 400
+	try:
+		episodes = episodes_in_window(g.conn, user_id, start, end, mode)
+		return jsonify({'episodes': [episode.as_json() for episode in episodes]})
 	except Exception as e:
-		return f"Error deleting symptom: {str(e)}", 500
+		return f"Error loading episodes: {str(e)}", 500
 
 
 #
-# TRIGGERS CRUD ROUTES
+# CHANGE FEED
+#
+# Every episode and reference-data write appends a row to pp2965.change_feed
+# inside its own transaction (an outbox), so the feed never shows a change
+# that was rolled back. Consumers page through it with the monotonic seq
+# cursor via /changes, or stay subscribed with the /changes/stream
+# Server-Sent Events endpoint, which is woken up by LISTEN/NOTIFY on a
+# single connection per process that all the streams share.
+#
+# A cursor is only safe if seqs become visible in order: a row with a lower
+# seq committing after a reader has moved past it would never be seen. So
+# writers take CHANGE_FEED_LOCK before drawing seqs and hold it until they
+# commit, and they record their changes last, right before committing, to
+# keep that window short.
+#
+# Each open stream holds a request thread for as long as it stays connected,
+# so a process serves at most CHANGE_FEED_MAX_STREAMS of them at a time
+# (half the threads of a worker under `serve`) and refuses more with a 503,
+# leaving the other threads to ordinary requests; /changes still works.
 #
 
-@app.route('/triggers')
-def triggers_list():
-	"""List all triggers"""
-	try:
-		query = "SELECT id, name FROM pp2965.triggers ORDER BY name"
-		triggers = g.conn.execute(text(query)).fetchall()
-		return render_template('triggers_list.html', triggers=triggers)
-	except Exception as e:
-		return f"Error loading triggers: {str(e)}", 500
+CHANGE_FEED_CHANNEL = 'pp2965_changes'
+# Set CHANGE_FEED_NOTIFY=0 to skip pg_notify; the stream then falls back to polling
+CHANGE_FEED_NOTIFY = os.environ.get('CHANGE_FEED_NOTIFY', '1') == '1'
+CHANGE_FEED_POLL_SECONDS = 5
+CHANGE_FEED_PAGE_SIZE = 500
+CHANGE_FEED_LOCK = "hashtext('pp2965.change_feed')"
+CHANGE_FEED_MAX_STREAMS = int(os.environ.get('CHANGE_FEED_MAX_STREAMS', 8))
+_stream_slots = threading.BoundedSemaphore(CHANGE_FEED_MAX_STREAMS)
 
-@app.route('/triggers/new')
-def trigger_new():
-	"""Show form to create new trigger"""
-	return render_template('trigger_form.html', trigger=None, action='create')
 
-@app.route('/triggers/create', methods=['POST'])
-def trigger_create():
-	"""Create a new trigger"""
-	try:
-		name = request.form['name']
-		g.conn.execute(text(
-			"INSERT INTO pp2965.triggers (name) VALUES (:name)"
-		), {'name': name})
-		g.conn.commit()
-		return redirect('/triggers')
-	except Exception as e:
-		return f"Error creating trigger: {str(e)}", 500
+def configure_stream_limit(limit):
+	"""Allow at most limit concurrent change streams in this process (0 refuses them all)"""
+	global _stream_slots
+	_stream_slots = threading.BoundedSemaphore(limit) if limit > 0 else threading.Semaphore(0)
 
-@app.route('/triggers/<int:trigger_id>/edit')
-def trigger_edit(trigger_id):
-	"""Show form to edit trigger"""
-	try:
-		row = g.conn.execute(text(
-			"SELECT id, name FROM pp2965.triggers WHERE id = :id"
-		), {'id': trigger_id}).fetchone()
-		if row is None:
-			return "Trigger not found", 404
-		trigger = {'id': row[0], 'name': row[1]}
-		return render_template('trigger_form.html', trigger=trigger, action='update')
-	except Exception as e:
-		return f"Error loading trigger: {str(e)}", 500
 
-@app.route('/triggers/<int:trigger_id>/update', methods=['POST'])
-def trigger_update(trigger_id):
-	"""Update a trigger"""
-	try:
-		name = request.form['name']
-		g.conn.execute(text(
-			"UPDATE pp2965.triggers SET name = :name WHERE id = :id"
-		), {'id': trigger_id, 'name': name})
-		g.conn.commit()
-		return redirect('/triggers')
-	except Exception as e:
-		return f"Error updating trigger: {str(e)}", 500
+def record_change(conn, entity, entity_id, op, user_id=None):
+	"""Append a change to the feed in the caller's transaction; returns its seq"""
+	return record_changes(conn, [(entity, entity_id, op, user_id)])
+
 
-@app.route('/triggers/<int:trigger_id>/delete', methods=['POST'])
-def trigger_delete(trigger_id):
-	"""Delete a trigger"""
+def record_changes(conn, changes):
+	"""
+	Append (entity, entity_id, op, user_id) tuples to the feed with a single
+	INSERT in the caller's transaction; returns the highest seq written.
+	Holds CHANGE_FEED_LOCK until the caller commits, so call it last. The
+	caches the changes make stale are dropped at the end of the request.
+	"""
+	if not changes:
+		return None
+	entities, entity_ids, ops, user_ids = (list(column) for column in zip(*changes))
+	stale = {'reference'} if any(entity != 'episode' for entity in entities) else set()
+	stale.update(('usage', int(user_id)) for entity, user_id in zip(entities, user_ids)
+		if entity == 'episode' and user_id is not None)
+	if has_request_context():
+		g.setdefault('stale_caches', set()).update(stale)
+	else:
+		drop_stale_caches(stale)
+	conn.execute(text(f"SELECT pg_advisory_xact_lock({CHANGE_FEED_LOCK})"))
+	seq = conn.execute(text("""
+		WITH written AS (
+			INSERT INTO pp2965.change_feed (entity, entity_id, op, user_id)
+			SELECT * FROM unnest(CAST(:entities AS text[]), CAST(:entity_ids AS integer[]),
+			                     CAST(:ops AS text[]), CAST(:user_ids AS integer[]))
+			RETURNING seq
+		)
+		SELECT MAX(seq) FROM written
+	"""), {'entities': entities, 'entity_ids': entity_ids, 'ops': ops, 'user_ids': user_ids}).scalar()
+	if CHANGE_FEED_NOTIFY:
+		# Delivered to listeners only when the transaction commits
+		conn.execute(text("SELECT pg_notify(:channel, :seq)"), {'channel': CHANGE_FEED_CHANNEL, 'seq': str(seq)})
+	return seq
+
+
+def drop_stale_caches(stale):
+	"""Drop the caches named in stale: 'reference' and ('usage', user_id)"""
+	if 'reference' in stale:
+		invalidate_reference_data()
+	invalidate_usage_counts({key[1] for key in stale if key != 'reference'})
+
+
+def changes_after(conn, after, limit=CHANGE_FEED_PAGE_SIZE, entity=None, user_id=None):
+	"""
+	Changes with seq > after, oldest first, as JSON-ready dicts.
+	With user_id, episode changes are limited to that user's episodes
+	(reference-data changes are shared by everyone and always included).
+	"""
+	rows = conn.execute(text("""
+		SELECT seq, entity, entity_id, op, user_id, changed_at
+		FROM pp2965.change_feed
+		WHERE seq > :after
+		  AND (CAST(:entity AS text) IS NULL OR entity = :entity)
+		  AND (CAST(:user_id AS integer) IS NULL OR entity <> 'episode' OR user_id = :user_id)
+		ORDER BY seq
+		LIMIT :limit
+	"""), {'after': after, 'limit': limit, 'entity': entity, 'user_id': user_id})
+	return [{
+		'seq': row[0],
+		'entity': row[1],
+		'entity_id': row[2],
+		'op': row[3],
+		'user_id': row[4],
+		'changed_at': row[5].isoformat()
+	} for row in rows]
+
+
+@app.route('/changes')
+def changes_list():
+	"""
+	One page of the change feed after the ?after=<seq> cursor
+	"""
+	after = request.args.get('after', 0, type=int)
+	limit = min(request.args.get('limit', CHANGE_FEED_PAGE_SIZE, type=int), CHANGE_FEED_PAGE_SIZE)
 	try:
-		g.conn.execute(text("DELETE FROM pp2965.triggers WHERE id = :id"), {'id': trigger_id})
-		g.conn.commit()
-		return redirect('/triggers')
+		changes = changes_after(g.conn, after, limit, request.args.get('entity'))
+		cursor = changes[-1]['seq'] if changes else after
+		return jsonify({'changes': changes, 'cursor': cursor})
 	except Exception as e:
-		return f"Error deleting trigger: {str(e)}", 500
+		return f"Error loading changes: {str(e)}", 500
+
+
+class ChangeNotifier:
+	"""
+	The one LISTEN connection of this process, shared by every
+	/changes/stream subscriber. It is opened outside the connection pool
+	(NullPool), so waiting streams hold no pool connections, and a
+	background thread wakes the streams on each notification.
+	"""
+	
+	def __init__(self, uri, channel):
+		self.uri = uri
+		self.channel = channel
+		self.listening = False
+		self._generation = 0
+		self._changed = threading.Condition()
+		self._thread = None
+		self._pid = None
+	
+	def generation(self):
+		"""Number of wake-ups so far, to pass to wait(); starts the listener if needed"""
+		with self._changed:
+			# Also after a fork, which leaves the listener thread behind in the parent
+			if self._pid != os.getpid() or not self._thread.is_alive():
+				self._pid, self.listening = os.getpid(), False
+				self._thread = threading.Thread(target=self._listen, name='change-feed-listener', daemon=True)
+				self._thread.start()
+			return self._generation
+	
+	def wait(self, generation, timeout):
+		"""
+		Block until there was a wake-up after generation or timeout passes;
+		True if woken. Without a LISTEN connection it returns True every
+		CHANGE_FEED_POLL_SECONDS, so the streams poll instead.
+		"""
+		with self._changed:
+			woken = lambda: self._generation != generation
+			if not self.listening:
+				self._changed.wait_for(woken, min(timeout, CHANGE_FEED_POLL_SECONDS))
+				return True
+			return self._changed.wait_for(woken, timeout)
+	
+	def _wake(self, listening=None):
+		with self._changed:
+			if listening is not None:
+				self.listening = listening
+			self._generation += 1
+			self._changed.notify_all()
+	
+	def _listen(self):
+		listen_engine = create_engine(self.uri, poolclass=NullPool)
+		while True:
+			raw = None
+			try:
+				raw = listen_engine.raw_connection()
+				dbapi_conn = raw.driver_connection
+				dbapi_conn.autocommit = True
+				with dbapi_conn.cursor() as cursor:
+					cursor.execute(f"LISTEN {self.channel}")
+				# Streams re-read the feed, in case they missed changes while polling
+				self._wake(listening=True)
+				with selectors.DefaultSelector() as selector:
+					selector.register(dbapi_conn, selectors.EVENT_READ)
+					while True:
+						if not selector.select(60):
+							# Quiet for a minute: check the connection is still alive
+							with dbapi_conn.cursor() as cursor:
+								cursor.execute("SELECT 1")
+						dbapi_conn.poll()
+						if dbapi_conn.notifies:
+							dbapi_conn.notifies.clear()
+							self._wake()
+			except Exception as e:
+				print(f"Change feed LISTEN unavailable, polling instead: {e}")
+			if self.listening:
+				self._wake(listening=False)
+			if raw is not None:
+				try:
+					raw.close()
+				except Exception:
+					pass
+			time.sleep(CHANGE_FEED_POLL_SECONDS)
+
+
+change_notifier = ChangeNotifier(DATABASEURI, CHANGE_FEED_CHANNEL) if CHANGE_FEED_NOTIFY else None
+
+
+@app.route('/changes/stream')
+def changes_stream():
+	"""
+	Server-Sent Events stream of the change feed; resumes from Last-Event-ID or ?after=<seq>
+	"""
+	after = request.headers.get('Last-Event-ID', type=int)
+	if after is None:
+		after = request.args.get('after', 0, type=int)
+	entity = request.args.get('entity')
+	slots = _stream_slots
+	if not slots.acquire(blocking=False):
+		return "Error: too many open change streams, try again later or page through /changes", 503, \
+			{'Retry-After': '30'}
+	
+	def events(after):
+		# Runs after the request is torn down, so it cannot use g.conn; each
+		# read borrows a pool connection only for the query
+		yield "retry: 3000\n\n"
+		while True:
+			seen = change_notifier.generation() if change_notifier else None
+			with engine.connect() as conn:
+				changes = changes_after(conn, after, entity=entity)
+			for change in changes:
+				after = change['seq']
+				yield f"id: {after}\nevent: change\ndata: {json.dumps(change)}\n\n"
+			if len(changes) == CHANGE_FEED_PAGE_SIZE:
+				continue
+			if change_notifier is None:
+				time.sleep(CHANGE_FEED_POLL_SECONDS)
+			elif not change_notifier.wait(seen, 15):
+				yield ": keep-alive\n\n"
+	
+	response = Response(events(after), mimetype='text/event-stream',
+		headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+	# Called when the server closes the response, even if it never started streaming
+	response.call_on_close(slots.release)
+	return response
 
 
 #
-# PAIN LOCATIONS CRUD ROUTES
+# OFFLINE SYNC
+#
+# Mobile clients queue episodes while offline and upload them with one
+# POST /sync (optionally Content-Encoding: gzip). The batch is applied in a
+# single transaction with set-based writes, and conflicts resolve the same
+# way every time:
+#   - new episodes carry a client_id that doubles as their idempotency key,
+#     so re-uploading a batch whose response was lost creates nothing twice
+#   - edits and deletes carry the version the client last saw; if the server
+#     copy has moved on since, the server wins and its current copy is
+#     returned under "conflicts" for the client to adopt
+#   - an accepted episode that overlaps another has the other's id under
+#     "overlaps"; with EPISODE_NO_OVERLAP it is refused as a conflict instead,
+#     and of two uploaded episodes that overlap the earlier one wins
+# The response also carries the server-side changes after the client's
+# sync_token (the change feed cursor) and the token to send next time.
 #
 
-@app.route('/pain_locations')
-def pain_locations_list():
-	"""List all pain locations"""
-	try:
-		query = "SELECT id, name FROM pp2965.pain_locations ORDER BY name"
-		pain_locations = g.conn.execute(text(query)).fetchall()
-		return render_template('pain_locations_list.html', pain_locations=pain_locations)
-	except Exception as e:
-		return f"Error loading pain locations: {str(e)}", 500
+SYNC_MAX_BYTES = 5 * 1024 * 1024
+SYNC_MAX_EPISODES = 1000
+
+
+def _json_body(max_bytes=SYNC_MAX_BYTES):
+	"""Parse the request body as JSON, inflating it first if it is gzip-encoded"""
+	data = request.get_data()
+	if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+		inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		data = inflater.decompress(data, max_bytes)
+		if inflater.unconsumed_tail:
+			abort(413)
+	if len(data) > max_bytes:
+		abort(413)
+	return json.loads(data)
+
+
+def episodes_by_id(conn, ids):
+	"""JSON-ready episodes, including their relationship ids, keyed by id"""
+	ids = sorted(set(ids))
+	if not ids:
+		return {}
+	episodes = {}
+	for episode in episodes_with_ids(conn, ids):
+		episodes[episode.id] = {**episode.as_json(), **{field: [] for field, _, _ in EPISODE_LINKS}}
+	for field, table, column in EPISODE_LINKS:
+		for episode_id, ref_id in conn.execute(text(
+			f"SELECT episode_id, {column} FROM pp2965.{table} WHERE episode_id = ANY(CAST(:ids AS integer[]))"
+		), {'ids': ids}):
+			episodes[episode_id][field].append(ref_id)
+	return episodes
+
+
+def _overlaps_in_batch(conn, user_id, rows):
+	"""
+	Positions of the episodes in rows to leave out under EPISODE_NO_OVERLAP.
+	Rows are new episodes, or edits when they carry the id of a stored one.
+	A statement's NOT EXISTS cannot see rows it writes itself, so the batch
+	is checked against itself here: in upload order, an episode is left out
+	if it overlaps a stored episode or an earlier one that is kept. An edit
+	is compared with the stored copies of the other episodes, and one that
+	leaves its time span as it is always passes.
+	"""
+	found = conn.execute(text(f"""
+		WITH batch AS (
+			SELECT * FROM json_to_recordset(CAST(:rows AS json)) AS b(
+				position integer, id integer, start_time {EPISODE_TIME_TYPE}, end_time {EPISODE_TIME_TYPE})
+			WHERE NOT EXISTS (
+				SELECT 1 FROM pp2965.episodes stored
+				WHERE stored.id = b.id AND stored.active_range = {_range_sql('b.start_time', 'b.end_time')}
+			)
+		)
+		SELECT b.position, NULL FROM batch b
+		WHERE EXISTS (
+			SELECT 1 FROM pp2965.episodes other
+			WHERE other.user_id = :user_id AND other.id IS DISTINCT FROM b.id
+			  AND {_overlap_sql('other', 'b.start_time', 'b.end_time')}
+		)
+		UNION ALL
+		SELECT b.position, earlier.position FROM batch b
+		JOIN batch earlier ON earlier.position < b.position
+		  AND {_span_sql('earlier.start_time', 'earlier.end_time')} && {_span_sql('b.start_time', 'b.end_time')}
+	"""), {'user_id': user_id, 'rows': json.dumps(rows, default=str)}).fetchall()
+	
+	overlaps_stored, overlaps_earlier = set(), collections.defaultdict(set)
+	for position, earlier in found:
+		if earlier is None:
+			overlaps_stored.add(position)
+		else:
+			overlaps_earlier[position].add(earlier)
+	kept, refused = set(), set()
+	for row in rows:
+		position = row['position']
+		if position in overlaps_stored or overlaps_earlier[position] & kept:
+			refused.add(position)
+		else:
+			kept.add(position)
+	return refused
 
-@app.route('/pain_locations/new')
-def pain_location_new():
-	"""Show form to create new pain location"""
-	return render_template('pain_location_form.html', pain_location=None, action='create')
 
-@app.route('/pain_locations/create', methods=['POST'])
-def pain_location_create():
-	"""Create a new pain location"""
-	try:
-		name = request.form['name']
-		g.conn.execute(text(
-			"INSERT INTO pp2965.pain_locations (name) VALUES (:name)"
-		), {'name': name})
-		g.conn.commit()
-		return redirect('/pain_locations')
-	except Exception as e:
-		return f"Error creating pain location: {str(e)}", 500
+def _sync_creates(conn, user_id, items, episodes, years, changes):
+	"""
+	Insert new episodes, given as items and their validated (fields, links),
+	with one statement per table. Returns
+	{client_id: episode_id}, including episodes created by an earlier upload;
+	with EPISODE_NO_OVERLAP, episodes overlapping one already stored are left out.
+	"""
+	parsed = {}
+	for item, episode in zip(items, episodes):
+		# The first copy of a client_id wins within a batch
+		parsed.setdefault(str(item['client_id']), episode)
+	if not parsed:
+		return {}
+	
+	rows = [{**fields, 'client_id': client_id, 'position': position}
+		for position, (client_id, (fields, _)) in enumerate(parsed.items())]
+	if EPISODE_NO_OVERLAP:
+		refused = _overlaps_in_batch(conn, user_id, rows)
+		rows = [row for row in rows if row['position'] not in refused]
+	overlap_check = f"""WHERE NOT EXISTS (
+			SELECT 1 FROM pp2965.episodes other
+			WHERE other.user_id = :user_id AND {_overlap_sql('other', 'e.start_time', 'e.end_time')}
+		)""" if EPISODE_NO_OVERLAP else ''
+	inserted = conn.execute(text(f"""
+		INSERT INTO pp2965.episodes 
+		(user_id, start_time, end_time, intensity, attack_type_id, had_menses, notes,
+		 created_at, updated_at, idempotency_key)
+		SELECT :user_id, e.start_time, e.end_time, e.intensity, e.attack_type_id, e.had_menses, e.notes,
+		       NOW(), NOW(), e.client_id
+		FROM json_to_recordset(CAST(:rows AS json)) AS e(
+			client_id text, start_time {EPISODE_TIME_TYPE}, end_time {EPISODE_TIME_TYPE}, intensity integer,
+			attack_type_id integer, had_menses boolean, notes text)
+		{overlap_check}
+		ON CONFLICT DO NOTHING
+		RETURNING id, idempotency_key, start_time, end_time
+	"""), {'user_id': user_id, 'rows': json.dumps(rows, default=str)}).fetchall()
+	
+	created = {row[1]: row[0] for row in inserted}
+	start_times = {row[0]: row[2] for row in inserted}
+	for field, table, column in EPISODE_LINKS:
+		link_rows = [(created[client_id], ref_id, start_times[created[client_id]])
+			for client_id, (_, links) in parsed.items() if client_id in created
+			for ref_id in sorted(set(links[field]))]
+		if link_rows:
+			episode_ids, ref_ids, episode_start_times = (list(column_values) for column_values in zip(*link_rows))
+			conn.execute(text(f"""
+				INSERT INTO pp2965.{table} (episode_id, {column}, episode_start_time)
+				SELECT * FROM unnest(CAST(:episode_ids AS integer[]), CAST(:ref_ids AS integer[]),
+				                     CAST(:start_times AS {EPISODE_TIME_TYPE}[]))
+			"""), {'episode_ids': episode_ids, 'ref_ids': ref_ids, 'start_times': episode_start_times})
+	for episode_id, _, start_time, end_time in inserted:
+		years.update(_episode_years(start_time, end_time))
+		changes.append(('episode', episode_id, 'create', user_id))
+	
+	# Already uploaded before: report the existing episodes, write nothing
+	retried = [client_id for client_id in parsed if client_id not in created]
+	if retried:
+		created.update(conn.execute(text("""
+			SELECT idempotency_key, id FROM pp2965.episodes
+			WHERE user_id = :user_id AND idempotency_key = ANY(CAST(:keys AS text[]))
+		"""), {'user_id': user_id, 'keys': retried}).fetchall())
+	return created
 
-@app.route('/pain_locations/<int:location_id>/edit')
-def pain_location_edit(location_id):
-	"""Show form to edit pain location"""
-	try:
-		row = g.conn.execute(text(
-			"SELECT id, name FROM pp2965.pain_locations WHERE id = :id"
-		), {'id': location_id}).fetchone()
-		if row is None:
-			return "Pain location not found", 404
-		pain_location = {'id': row[0], 'name': row[1]}
-		return render_template('pain_location_form.html', pain_location=pain_location, action='update')
-	except Exception as e:
-		return f"Error loading pain location: {str(e)}", 500
 
-@app.route('/pain_locations/<int:location_id>/update', methods=['POST'])
-def pain_location_update(location_id):
-	"""Update a pain location"""
+def _sync_edits(conn, user_id, items, episodes, years, changes):
+	"""
+	Compare-and-swap update of episodes, given as items and their validated
+	(fields, links, version), with one statement per table. The episodes are
+	locked in id order first, so concurrent syncs wait for each other instead
+	of deadlocking. Returns {episode_id: None if applied, else the conflict
+	reason}; of several edits of one episode only the first is applied.
+	"""
+	parsed = {}
+	for item, episode in zip(items, episodes):
+		parsed.setdefault(int(item['id']), episode)
+	if not parsed:
+		return {}
+	old = {row[0]: row[1:] for row in conn.execute(text("""
+		SELECT id, start_time, end_time, version FROM pp2965.episodes
+		WHERE user_id = :user_id AND id = ANY(CAST(:ids AS integer[]))
+		ORDER BY id
+		FOR UPDATE
+	"""), {'user_id': user_id, 'ids': sorted(parsed)})}
+	results = {episode_id: 'deleted' for episode_id in parsed if episode_id not in old}
+	rows = [{**fields, 'id': episode_id, 'version': version, 'position': position}
+		for position, (episode_id, (fields, _, version)) in enumerate(parsed.items()) if episode_id in old]
+	
+	writes = rows
+	if EPISODE_NO_OVERLAP:
+		refused = _overlaps_in_batch(conn, user_id, rows)
+		writes = [row for row in rows if row['position'] not in refused]
+	updated = conn.execute(text(f"""
+		UPDATE pp2965.episodes e
+		SET start_time = d.start_time,
+		    end_time = d.end_time,
+		    intensity = d.intensity,
+		    attack_type_id = d.attack_type_id,
+		    had_menses = d.had_menses,
+		    notes = d.notes,
+		    version = e.version + 1,
+		    updated_at = NOW()
+		FROM json_to_recordset(CAST(:rows AS json)) AS d(
+			id integer, version integer, start_time {EPISODE_TIME_TYPE}, end_time {EPISODE_TIME_TYPE},
+			intensity integer, attack_type_id integer, had_menses boolean, notes text)
+		WHERE e.id = d.id AND (d.version IS NULL OR e.version = d.version)
+		RETURNING e.id, e.start_time, e.end_time
+	"""), {'rows': json.dumps(writes, default=str)}).fetchall() if writes else []
+	
+	# On a partitioned table, moving an episode to another month's partition
+	# deletes its links (before PostgreSQL 15), so this puts them back too
+	_replace_episode_links(conn, {episode_id: (start_time, parsed[episode_id][1])
+		for episode_id, start_time, _ in updated})
+	for episode_id, start_time, end_time in updated:
+		# Recompute the calendar days of both the old and the new time span
+		years.update(_episode_years(*old[episode_id][:2]) | _episode_years(start_time, end_time))
+		changes.append(('episode', episode_id, 'update', user_id))
+		results[episode_id] = None
+	
+	# Not written: a retry of an edit already applied counts as applied, else
+	# the version moved on or, with the version current, the span overlaps
+	missed = [row for row in rows if row['id'] not in results]
+	if missed:
+		unchanged = {row[0] for row in conn.execute(text(f"""
+			SELECT e.id FROM pp2965.episodes e
+			JOIN json_to_recordset(CAST(:rows AS json)) AS d(
+				id integer, start_time {EPISODE_TIME_TYPE}, end_time {EPISODE_TIME_TYPE},
+				intensity integer, attack_type_id integer, had_menses boolean, notes text) ON d.id = e.id
+			WHERE e.start_time IS NOT DISTINCT FROM d.start_time
+			  AND e.end_time IS NOT DISTINCT FROM d.end_time
+			  AND e.intensity IS NOT DISTINCT FROM d.intensity
+			  AND e.attack_type_id IS NOT DISTINCT FROM d.attack_type_id
+			  AND e.had_menses IS NOT DISTINCT FROM d.had_menses
+			  AND e.notes IS NOT DISTINCT FROM d.notes
+		"""), {'rows': json.dumps(missed, default=str)})}
+		stored = episodes_by_id(conn, unchanged)
+		for row in missed:
+			episode_id, (_, links, version) = row['id'], parsed[row['id']]
+			if episode_id in stored and all(
+					set(stored[episode_id][field]) == set(links.get(field, ())) for field, _, _ in EPISODE_LINKS):
+				results[episode_id] = None
+			elif EPISODE_NO_OVERLAP and (version is None or old[episode_id][2] == version):
+				results[episode_id] = 'overlap'
+			else:
+				results[episode_id] = 'version'
+	return results
+
+
+def _sync_deletes(conn, user_id, items, years, changes):
+	"""
+	Delete episodes whose version still matches in one statement. Returns the
+	ids that were kept because the server copy changed in the meantime.
+	"""
+	ids = [int(item['id']) for item in items]
+	versions = [item.get('version') for item in items]
+	deleted = conn.execute(text("""
+		DELETE FROM pp2965.episodes e
+		USING unnest(CAST(:ids AS integer[]), CAST(:versions AS integer[])) AS d(id, version)
+		WHERE e.id = d.id AND e.user_id = :user_id AND (d.version IS NULL OR e.version = d.version)
+		RETURNING e.id, e.start_time, e.end_time
+	"""), {'user_id': user_id, 'ids': ids, 'versions': versions}).fetchall()
+	for episode_id, start_time, end_time in deleted:
+		years.update(_episode_years(start_time, end_time))
+		changes.append(('episode', episode_id, 'delete', user_id))
+	missed = set(ids) - {row[0] for row in deleted}
+	if not missed:
+		return set()
+	# Ids that are gone entirely were already deleted, which is what the client wanted
+	return {row[0] for row in conn.execute(text(
+		"SELECT id FROM pp2965.episodes WHERE user_id = :user_id AND id = ANY(CAST(:ids AS integer[]))"
+	), {'user_id': user_id, 'ids': sorted(missed)})}
+
+
+def apply_sync_batch(conn, user_id, items):
+	"""
+	Apply uploaded episodes for one user (caller commits).
+	Returns (applied, conflicts): applied maps each accepted item to its
+	server id, conflicts lists items where the server copy won.
+	"""
+	creates = [item for item in items if not item.get('id')]
+	deletes = [item for item in items if item.get('id') and item.get('deleted')]
+	edits = [item for item in items if item.get('id') and not item.get('deleted')]
+	years, changes = set(), []
+	applied, conflicts = [], []
+	
+	# Every uploaded episode is checked before anything is written
+	values = validate_with_references(conn, EPISODE_JSON, creates + edits)
+	episodes = [(*_split_episode(episode), episode['version']) for episode in values]
+	
+	created = _sync_creates(conn, user_id, creates, [episode[:2] for episode in episodes[:len(creates)]],
+		years, changes)
+	for client_id, episode_id in created.items():
+		applied.append({'client_id': client_id, 'id': episode_id})
+	for client_id in dict.fromkeys(str(item['client_id']) for item in creates):
+		if client_id not in created:
+			conflicts.append({'client_id': client_id, 'id': None, 'reason': 'overlap'})
+	
+	edited = _sync_edits(conn, user_id, edits, episodes[len(creates):], years, changes)
+	for item in edits:
+		episode_id = int(item['id'])
+		# A second edit of the same episode lost to the first one
+		reason = edited.pop(episode_id, 'version')
+		if reason is None:
+			applied.append({'client_id': item.get('client_id'), 'id': episode_id})
+		else:
+			conflicts.append({'client_id': item.get('client_id'), 'id': episode_id, 'reason': reason})
+	
+	kept = _sync_deletes(conn, user_id, deletes, years, changes) if deletes else set()
+	for item in deletes:
+		episode_id = int(item['id'])
+		if episode_id in kept:
+			conflicts.append({'client_id': item.get('client_id'), 'id': episode_id, 'reason': 'version'})
+		else:
+			applied.append({'client_id': item.get('client_id'), 'id': episode_id, 'deleted': True})
+	
+	refresh_heatmap(conn, user_id, years)
+	
+	# Hand back current versions, and the server copy for every conflict
+	current = episodes_by_id(conn, [entry['id'] for entry in applied + conflicts if entry['id'] is not None])
+	for entry in applied:
+		if not entry.get('deleted'):
+			entry['version'] = current[entry['id']]['version']
+	for entry in conflicts:
+		entry['server'] = current.get(entry['id'])
+	overlaps = episode_overlaps(conn, [entry['id'] for entry in applied if not entry.get('deleted')])
+	for entry in applied:
+		if entry['id'] in overlaps:
+			entry['overlaps'] = overlaps[entry['id']]
+	record_changes(conn, changes)
+	return applied, conflicts
+
+
+@app.route('/sync', methods=['POST'])
+@rate_limited
+def sync():
+	"""
+	Apply a batch of offline episode changes and return server changes since sync_token
+	"""
+	try:
+		body = _json_body()
+		request_values = SYNC_REQUEST.validate(body)
+		user_id, sync_token = request_values['user_id'], request_values['sync_token']
+		items = body.get('episodes') or []
+	except (ValueError, TypeError, AttributeError, zlib.error) as e:
+		return f"Error: invalid sync request: {str(e)}", 400
+	if len(items) > SYNC_MAX_EPISODES:
+		return f"Error: at most {SYNC_MAX_EPISODES} episodes per sync", 413
+	
 	try:
-		name = request.form['name']
-		g.conn.execute(text(
-			"UPDATE pp2965.pain_locations SET name = :name WHERE id = :id"
-		), {'id': location_id, 'name': name})
+		applied, conflicts = apply_sync_batch(g.conn, user_id, items)
 		g.conn.commit()
-		return redirect('/pain_locations')
+	except (KeyError, ValueError, TypeError) as e:
+		g.conn.rollback()
+		return f"Error: invalid episode in batch: {str(e)}", 400
 	except Exception as e:
-		return f"Error updating pain location: {str(e)}", 500
-
-@app.route('/pain_locations/<int:location_id>/delete', methods=['POST'])
-def pain_location_delete(location_id):
-	"""Delete a pain location"""
+		return f"Error syncing: {str(e)}", 500
+	
 	try:
-		g.conn.execute(text("DELETE FROM pp2965.pain_locations WHERE id = :id"), {'id': location_id})
-		g.conn.commit()
-		return redirect('/pain_locations')
+		changes = changes_after(g.conn, sync_token, user_id=user_id)
+		changed_ids = {c['entity_id'] for c in changes if c['entity'] == 'episode'}
+		changed = episodes_by_id(g.conn, changed_ids)
+		return jsonify({
+			'applied': applied,
+			'conflicts': conflicts,
+			'changes': {
+				'episodes': list(changed.values()),
+				'deleted': sorted(changed_ids - changed.keys()),
+				'reference': [c for c in changes if c['entity'] != 'episode']
+			},
+			'sync_token': changes[-1]['seq'] if changes else sync_token,
+			'has_more': len(changes) == CHANGE_FEED_PAGE_SIZE
+		})
 	except Exception as e:
-		return f"Error deleting pain location: {str(e)}", 500
+		return f"Error loading changes: {str(e)}", 500
 
 
 #
-# ATTACK TYPES CRUD ROUTES
+# REFERENCE DATA CRUD ROUTES
+#
+# Medications, symptoms, triggers, pain locations and attack types all get
+# the same pages: a paginated list with prefix search, new/create,
+# edit/update and delete. There is also a JSON bulk endpoint for creating,
+# renaming, deleting and merging many entries in one statement each. Each
+# table is described once by a ReferenceEntity. register_reference_routes()
+# generates its views under the original URLs and endpoint names, for
+# example /symptoms -> symptoms_list and /symptoms/<id>/edit -> symptom_edit.
 #
 
-@app.route('/attack_types')
-def attack_types_list():
-	"""List all attack types"""
-	try:
-		query = "SELECT id, name FROM pp2965.attack_types ORDER BY name"
-		attack_types = g.conn.execute(text(query)).fetchall()
-		return render_template('attack_types_list.html', attack_types=attack_types)
-	except Exception as e:
-		return f"Error loading attack types: {str(e)}", 500
+REFERENCE_PAGE_SIZE = 50
 
-@app.route('/attack_types/new')
-def attack_type_new():
-	"""Show form to create new attack type"""
-	return render_template('attack_type_form.html', attack_type=None, action='create')
 
-@app.route('/attack_types/create', methods=['POST'])
-def attack_type_create():
-	"""Create a new attack type"""
-	try:
-		name = request.form['name']
-		g.conn.execute(text(
-			"INSERT INTO pp2965.attack_types (name) VALUES (:name)"
-		), {'name': name})
-		g.conn.commit()
-		return redirect('/attack_types')
-	except Exception as e:
-		return f"Error creating attack type: {str(e)}", 500
+class ReferenceEntity:
+	"""
+	A reference table and how its pages work.
+	schema validates the posted form; its fields are the table's columns in
+	form order, the name column first.
+	links lists the (table, column) pairs that point at this table's ids;
+	junction tables are merged row by row, pp2965.episodes is updated.
+	"""
+	
+	def __init__(self, table, singular, label, schema, links):
+		self.table = table
+		self.singular = singular
+		self.label = label
+		self.schema = schema
+		self.links = links
+		self.name_column = schema.names[0]
+		self.columns = ', '.join(['id'] + schema.names)
+	
+	@property
+	def plural(self):
+		return self.table.replace('_', ' ')
+	
+	def parse_form(self, form):
+		"""Typed column values of a posted form; raises ValidationError"""
+		return self.schema.validate(form)
+	
+	def get(self, conn, item_id):
+		if self.table == 'medications':
+			return get_medication(conn, item_id)
+		return get_reference_item(conn, self.table, item_id)
+	
+	def page(self, conn, prefix, page):
+		"""
+		One page of rows ordered by name, optionally only names starting with
+		prefix (case-insensitive). Both the filter and the order are served by
+		the lower(name) index. Returns (rows, has_next).
+		"""
+		where, params = '', {'limit': REFERENCE_PAGE_SIZE + 1, 'offset': (page - 1) * REFERENCE_PAGE_SIZE}
+		if prefix:
+			where = f'WHERE lower({self.name_column}) COLLATE "C" LIKE :prefix'
+			params['prefix'] = _escape_like(prefix.lower()) + '%'
+		rows = conn.execute(text(f"""
+			SELECT {self.columns} FROM pp2965.{self.table}
+			{where}
+			ORDER BY lower({self.name_column}) COLLATE "C", id
+			LIMIT :limit OFFSET :offset
+		"""), params).fetchall()
+		return rows[:REFERENCE_PAGE_SIZE], len(rows) > REFERENCE_PAGE_SIZE
+
+
+def _escape_like(value):
+	return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+REFERENCE_ENTITIES = (
+	ReferenceEntity('medications', 'medication', 'Medication', MEDICATION_FORM,
+		(('episode_medications', 'medication_id'),)),
+	ReferenceEntity('symptoms', 'symptom', 'Symptom', NAME_FORM,
+		(('episode_symptoms', 'symptom_id'),)),
+	ReferenceEntity('triggers', 'trigger', 'Trigger', NAME_FORM,
+		(('episode_triggers', 'trigger_id'),)),
+	ReferenceEntity('pain_locations', 'pain_location', 'Pain location', NAME_FORM,
+		(('episode_pain_locations', 'pain_location_id'),)),
+	ReferenceEntity('attack_types', 'attack_type', 'Attack type', NAME_FORM,
+		(('episodes', 'attack_type_id'),)),
+)
+
+
+def merge_reference_items(conn, entity, pairs):
+	"""
+	Fold each (source_id, target_id) pair into its target: links to the
+	source are repointed to the target (without duplicating a link the
+	episode already has) and the source row is deleted. Touched episodes get
+	a new version and a change feed entry. Caller commits.
+	"""
+	pairs = [(source, target) for source, target in pairs if source != target]
+	if not pairs:
+		return 0
+	params = {'sources': [source for source, _ in pairs], 'targets': [target for _, target in pairs]}
+	mapping = "unnest(CAST(:sources AS integer[]), CAST(:targets AS integer[])) AS m(source, target)"
+	touched = set()
+	for table, column in entity.links:
+		if table == 'episodes':
+			touched.update(row[0] for row in conn.execute(text(f"""
+				UPDATE pp2965.episodes e SET {column} = m.target
+				FROM {mapping}
+				WHERE e.{column} = m.source
+				RETURNING e.id
+			"""), params))
+			continue
+		conn.execute(text(f"""
+			INSERT INTO pp2965.{table} (episode_id, {column}, episode_start_time)
+			SELECT DISTINCT j.episode_id, m.target, e.start_time
+			FROM pp2965.{table} j JOIN {mapping} ON j.{column} = m.source
+			JOIN pp2965.episodes e ON e.id = j.episode_id
+			WHERE NOT EXISTS (
+				SELECT 1 FROM pp2965.{table} k WHERE k.episode_id = j.episode_id AND k.{column} = m.target
+			)
+		"""), params)
+		touched.update(row[0] for row in conn.execute(text(f"""
+			DELETE FROM pp2965.{table} j
+			USING {mapping}
+			WHERE j.{column} = m.source
+			RETURNING j.episode_id
+		"""), params))
+	
+	conn.execute(text(f"DELETE FROM pp2965.{entity.table} WHERE id = ANY(CAST(:sources AS integer[]))"), params)
+	changes = [(entity.singular, source, 'delete', None) for source, _ in pairs]
+	if touched:
+		changes += [('episode', row[0], 'update', row[1]) for row in conn.execute(text("""
+			UPDATE pp2965.episodes SET version = version + 1, updated_at = NOW()
+			WHERE id = ANY(CAST(:ids AS integer[]))
+			RETURNING id, user_id
+		"""), {'ids': sorted(touched)})]
+	record_changes(conn, changes)
+	return len(pairs)
+
+
+def bulk_reference_action(conn, entity, body):
+	"""
+	Run one bulk action from a JSON body (caller commits):
+	  {"action": "create", "names": [...]}
+	  {"action": "rename", "items": [{"id": 1, "name": "..."}, ...]}
+	  {"action": "delete", "ids": [...]}
+	  {"action": "merge", "target": 1, "ids": [...]}
+	  {"action": "dedupe"}  (merge rows equal up to case/whitespace in every column into the oldest)
+	"""
+	action = body.get('action')
+	name = entity.name_column
+	if action == 'create':
+		# Each name goes through the entity's form schema: stripped, not blank, not too long
+		names = [values[name] for values in entity.schema.validate_all([{name: n} for n in body['names']])]
+		ids = [row[0] for row in conn.execute(text(f"""
+			INSERT INTO pp2965.{entity.table} ({name})
+			SELECT unnest(CAST(:names AS text[]))
+			RETURNING id
+		"""), {'names': names})]
+		record_changes(conn, [(entity.singular, item_id, 'create', None) for item_id in ids])
+		return {'action': action, 'ids': ids}
+	if action == 'rename':
+		items = body['items']
+		names = [values[name] for values in entity.schema.validate_all([{name: item['name']} for item in items])]
+		ids = [row[0] for row in conn.execute(text(f"""
+			UPDATE pp2965.{entity.table} t SET {name} = v.name
+			FROM unnest(CAST(:ids AS integer[]), CAST(:names AS text[])) AS v(id, name)
+			WHERE t.id = v.id
+			RETURNING t.id
+		"""), {'ids': [int(item['id']) for item in items], 'names': names})]
+		record_changes(conn, [(entity.singular, item_id, 'update', None) for item_id in ids])
+		return {'action': action, 'ids': ids}
+	if action == 'delete':
+		ids = [row[0] for row in conn.execute(text(
+			f"DELETE FROM pp2965.{entity.table} WHERE id = ANY(CAST(:ids AS integer[])) RETURNING id"
+		), {'ids': [int(i) for i in body['ids']]})]
+		record_changes(conn, [(entity.singular, item_id, 'delete', None) for item_id in ids])
+		return {'action': action, 'ids': ids}
+	if action == 'merge':
+		target = int(body['target'])
+		if entity.get(conn, target) is None:
+			raise LookupError(target)
+		pairs = [(int(i), target) for i in body['ids']]
+	elif action == 'dedupe':
+		# Rows are duplicates only if every form column matches, so medications
+		# with the same name but another dose or route are kept apart
+		same = ', '.join(f"lower(btrim(CAST({column} AS text)))" for column in entity.schema.names)
+		pairs = conn.execute(text(f"""
+			SELECT id, keep FROM (
+				SELECT id, MIN(id) OVER (PARTITION BY {same}) AS keep
+				FROM pp2965.{entity.table}
+			) grouped
+			WHERE id <> keep
+		""")).fetchall()
+	else:
+		raise ValueError(f"unknown action {action!r}")
+	return {'action': action, 'merged': merge_reference_items(conn, entity, pairs)}
+
+
+def register_reference_routes(entity):
+	"""Add the list/new/create/edit/update/delete/bulk views of a reference table"""
+	url, template_var = f'/{entity.table}', entity.singular
+	list_template, form_template = f'{entity.table}_list.html', f'{entity.singular}_form.html'
+	
+	@read_only
+	def list_view():
+		try:
+			q = request.args.get('q', '').strip()
+			page = max(request.args.get('page', 1, type=int), 1)
+			rows, has_next = entity.page(g.conn, q, page)
+			return render_template(list_template, q=q, page=page, has_next=has_next, **{entity.table: rows})
+		except Exception as e:
+			return f"Error loading {entity.plural}: {str(e)}", 500
+	
+	def new_view():
+		return render_template(form_template, action='create', **{template_var: None})
+	
+	def create_view():
+		try:
+			values = entity.parse_form(request.form)
+			item_id = g.conn.execute(text(f"""
+				INSERT INTO pp2965.{entity.table} ({', '.join(values)})
+				VALUES ({', '.join(':' + column for column in values)})
+				RETURNING id
+			"""), values).scalar()
+			record_change(g.conn, entity.singular, item_id, 'create')
+			g.conn.commit()
+			return redirect(url)
+		except ValidationError as e:
+			return f"Error: {e}", 400
+		except Exception as e:
+			return f"Error creating {entity.label.lower()}: {str(e)}", 500
+	
+	def edit_view(item_id):
+		try:
+			item = entity.get(g.conn, item_id)
+			if item is None:
+				return f"{entity.label} not found", 404
+			return render_template(form_template, action='update', **{template_var: item})
+		except Exception as e:
+			return f"Error loading {entity.label.lower()}: {str(e)}", 500
+	
+	def update_view(item_id):
+		try:
+			values = entity.parse_form(request.form)
+			g.conn.execute(text(f"""
+				UPDATE pp2965.{entity.table}
+				SET {', '.join(f'{column} = :{column}' for column in values)}
+				WHERE id = :id
+			"""), {**values, 'id': item_id})
+			record_change(g.conn, entity.singular, item_id, 'update')
+			g.conn.commit()
+			return redirect(url)
+		except ValidationError as e:
+			return f"Error: {e}", 400
+		except Exception as e:
+			return f"Error updating {entity.label.lower()}: {str(e)}", 500
+	
+	def delete_view(item_id):
+		try:
+			g.conn.execute(text(f"DELETE FROM pp2965.{entity.table} WHERE id = :id"), {'id': item_id})
+			record_change(g.conn, entity.singular, item_id, 'delete')
+			g.conn.commit()
+			return redirect(url)
+		except Exception as e:
+			return f"Error deleting {entity.label.lower()}: {str(e)}", 500
+	
+	def bulk_view():
+		try:
+			result = bulk_reference_action(g.conn, entity, _json_body())
+			g.conn.commit()
+			return jsonify(result)
+		except LookupError as e:
+			g.conn.rollback()
+			return f"Error: {entity.label.lower()} {e} not found", 404
+		except (KeyError, TypeError, ValueError, AttributeError) as e:
+			g.conn.rollback()
+			return f"Error: invalid bulk request: {str(e)}", 400
+		except Exception as e:
+			return f"Error in bulk {entity.plural} update: {str(e)}", 500
+	
+	for view in (create_view, update_view, delete_view, bulk_view):
+		rate_limited(view)
+	prefix = entity.singular
+	app.add_url_rule(url, f'{entity.table}_list', list_view)
+	app.add_url_rule(f'{url}/new', f'{prefix}_new', new_view)
+	app.add_url_rule(f'{url}/create', f'{prefix}_create', create_view, methods=['POST'])
+	app.add_url_rule(f'{url}/<int:item_id>/edit', f'{prefix}_edit', edit_view)
+	app.add_url_rule(f'{url}/<int:item_id>/update', f'{prefix}_update', update_view, methods=['POST'])
+	app.add_url_rule(f'{url}/<int:item_id>/delete', f'{prefix}_delete', delete_view, methods=['POST'])
+	app.add_url_rule(f'{url}/bulk', f'{entity.table}_bulk', bulk_view, methods=['POST'])
 
-@app.route('/attack_types/<int:attack_type_id>/edit')
-def attack_type_edit(attack_type_id):
-	"""Show form to edit attack type"""
-	try:
-		row = g.conn.execute(text(
-			"SELECT id, name FROM pp2965.attack_types WHERE id = :id"
-		), {'id': attack_type_id}).fetchone()
-		if row is None:
-			return "Attack type not found", 404
-		attack_type = {'id': row[0], 'name': row[1]}
-		return render_template('attack_type_form.html', attack_type=attack_type, action='update')
-	except Exception as e:
-		return f"Error loading attack type: {str(e)}", 500
 
-@app.route('/attack_types/<int:attack_type_id>/update', methods=['POST'])
-def attack_type_update(attack_type_id):
-	"""Update an attack type"""
+for reference_entity in REFERENCE_ENTITIES:
+	register_reference_routes(reference_entity)
+
+
+#
+# AUTOCOMPLETE
+#
+# /autocomplete/<kind>?q=... returns the top-k reference entries for what
+# the user has typed so far, ranked by how often that user picked them.
+# Lookups run against a PrefixIndex built from the reference data cache,
+# so a reference write (which drops that cache) also rebuilds the index.
+# Usage counts come from the junction tables, cached per user for
+# USAGE_CACHE_SECONDS and dropped when the user's episodes change.
+#
+
+USAGE_CACHE_SECONDS = 300
+AUTOCOMPLETE_MAX_RESULTS = 50
+
+_autocomplete_indexes = {}  # kind -> (reference data snapshot it was built from, PrefixIndex)
+_usage_cache = {}  # (user_id, kind) -> (expires, {reference id: times used})
+_usage_generation = collections.Counter()  # user_id -> invalidations so far
+
+
+def autocomplete_index(conn, kind):
+	"""PrefixIndex over the names of one EPISODE_LINKS field's reference table"""
+	data = reference_data(conn)
+	cached = _autocomplete_indexes.get(kind)
+	if cached is None or cached[0] is not data:
+		if kind == 'medications':
+			items = [(row[0], f"{row[1]} ({row[2]}mg)" if row[2] else row[1]) for row in data[kind]]
+		else:
+			items = [(row[0], row[1]) for row in data[kind]]
+		cached = (data, PrefixIndex(items))
+		_autocomplete_indexes[kind] = cached
+	return cached[1]
+
+
+def usage_counts(conn, user_id, kind):
+	"""How many of the user's episodes are linked to each reference id"""
+	cached = _usage_cache.get((user_id, kind))
+	if cached is not None and time.monotonic() < cached[0]:
+		return cached[1]
+	table, column = next((table, column) for field, table, column in EPISODE_LINKS if field == kind)
+	generation = _usage_generation[user_id]
+	counts = dict(conn.execute(text(f"""
+		SELECT j.{column}, COUNT(*)
+		FROM pp2965.{table} j
+		JOIN pp2965.episodes e ON e.id = j.episode_id
+		WHERE e.user_id = :user_id
+		GROUP BY j.{column}
+	"""), {'user_id': user_id}).fetchall())
+	if _usage_generation[user_id] == generation:
+		_usage_cache[(user_id, kind)] = (time.monotonic() + USAGE_CACHE_SECONDS, counts)
+	return counts
+
+
+def invalidate_usage_counts(user_ids):
+	_usage_generation.update(user_ids)
+	for key in [key for key in _usage_cache if key[0] in user_ids]:
+		_usage_cache.pop(key, None)
+
+
+@app.route('/autocomplete/<kind>')
+@read_only
+def autocomplete(kind):
+	"""
+	Top-k matches for ?q= among symptoms, triggers, pain_locations or medications, as JSON
+	"""
+	if kind not in {field for field, _, _ in EPISODE_LINKS}:
+		abort(404)
+	q = request.args.get('q', '')
+	k = min(max(request.args.get('k', 10, type=int), 1), AUTOCOMPLETE_MAX_RESULTS)
+	user_id = request.args.get('user_id', 1, type=int)
 	try:
-		name = request.form['name']
-		g.conn.execute(text(
-			"UPDATE pp2965.attack_types SET name = :name WHERE id = :id"
-		), {'id': attack_type_id, 'name': name})
-		g.conn.commit()
-		return redirect('/attack_types')
+		index = autocomplete_index(g.conn, kind)
+		matches = index.search(q, k, usage_counts(g.conn, user_id, kind))
+		return jsonify({'query': q, 'results': [{'id': item_id, 'name': name} for item_id, name in matches]})
 	except Exception as e:
-		return f"Error updating attack type: {str(e)}", 500
+		return f"Error searching {kind}: {str(e)}", 500
+
 
-@app.route('/attack_types/<int:attack_type_id>/delete', methods=['POST'])
-def attack_type_delete(attack_type_id):
-	"""Delete an attack type"""
+#
+# COHORT REPORTS
+#
+# Population-level statistics across all users (trigger prevalence, mean
+# intensity by attack type, menses correlation) are computed from a Parquet
+# snapshot in REPORTS_DIR, never from the live tables. Take snapshots on a
+# schedule with `flask --app server snapshot-reports --every 3600` (or from
+# cron without --every); they are read from a replica when there is one.
+# /reports/cohort answers from the newest snapshot and keeps the result
+# until the next one. Needs the pyarrow and duckdb packages.
+#
+
+REPORTS_DIR = os.environ.get('REPORTS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reports'))
+
+_cohort_report_cache = {}  # snapshot path -> report
+_cohort_report_lock = threading.Lock()
+
+
+@app.cli.command('snapshot-reports')
+@click.option('--every', default=0, show_default=True, type=float,
+	help='Keep running and take a snapshot every this many seconds (0 = once)')
+def snapshot_reports_command(every):
+	"""Snapshot the episode tables for cohort reports"""
+	os.makedirs(REPORTS_DIR, exist_ok=True)
+	while True:
+		started = time.perf_counter()
+		try:
+			with (replica_engines[0] if replica_engines else engine).connect() as conn:
+				path, rows = snapshot_reports(conn, REPORTS_DIR)
+			counts = ', '.join(f"{table} {count}" for table, count in rows.items())
+			print(f"Snapshot {path} in {time.perf_counter() - started:.1f} s: {counts}")
+		except Exception as e:
+			if not every:
+				raise
+			print(f"Snapshot failed: {e}")
+		if not every:
+			return
+		time.sleep(every)
+
+
+@app.route('/reports/cohort')
+@read_only
+def reports_cohort():
+	"""
+	Cohort statistics across all users from the newest report snapshot
+	"""
+	path = current_snapshot(REPORTS_DIR)
+	if path is None:
+		return "No report snapshot yet: run flask --app server snapshot-reports", 503
 	try:
-		g.conn.execute(text("DELETE FROM pp2965.attack_types WHERE id = :id"), {'id': attack_type_id})
-		g.conn.commit()
-		return redirect('/attack_types')
+		with _cohort_report_lock:
+			if path not in _cohort_report_cache:
+				_cohort_report_cache.clear()
+				_cohort_report_cache[path] = cohort_report(path)
+			report = _cohort_report_cache[path]
+		return jsonify(report)
 	except Exception as e:
-		return f"Error deleting attack type: {str(e)}", 500
+		return f"Error computing cohort report: {str(e)}", 500
 
 
 @app.route('/login')
@@ -1034,12 +2775,162 @@ def login():
 	this_is_never_executed()
 
 
-if __name__ == "__main__":
-	import click
+#
+# PARTITIONING
+#
+# `flask --app server partition-episodes` converts episodes and the junction
+# tables to monthly partitions once (see partitions.py); it locks the tables
+# while it copies them, so run it in a quiet moment. After that, run
+# `flask --app server maintain-partitions` daily (cron): it creates the
+# partitions for the next PARTITION_MONTHS_AHEAD months, moves episodes
+# that landed in the DEFAULT partitions (backdated, archived months, or
+# past the last partition when cron has not run) into partitions of their
+# months and, when EPISODE_RETENTION_MONTHS is set, exports months older
+# than that to ARCHIVE_DIR as .csv.gz files and drops them.
+#
+
+PARTITION_LINKS = [(table, column) for _, table, column in EPISODE_LINKS]
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+EPISODE_RETENTION_MONTHS = int(os.environ.get('EPISODE_RETENTION_MONTHS', 0))
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+
+
+@app.cli.command('partition-episodes')
+@click.option('--months-ahead', default=PARTITION_MONTHS_AHEAD, show_default=True, type=int)
+def partition_episodes_command(months_ahead):
+	"""Convert episodes and its junction tables to monthly partitions"""
+	started = time.perf_counter()
+	with engine.connect() as conn:
+		if not partition_episodes(conn, PARTITION_LINKS, months_ahead):
+			print("pp2965.episodes is already partitioned")
+			return
+		conn.commit()
+	print(f"Partitioned episodes in {time.perf_counter() - started:.1f} s")
+
+
+@app.cli.command('maintain-partitions')
+@click.option('--months-ahead', default=PARTITION_MONTHS_AHEAD, show_default=True, type=int)
+@click.option('--retain-months', default=EPISODE_RETENTION_MONTHS, show_default=True, type=int,
+	help='Archive and drop months older than this (0 = keep everything)')
+@click.option('--archive-dir', default=ARCHIVE_DIR, show_default=True)
+def maintain_partitions_command(months_ahead, retain_months, archive_dir):
+	"""Create upcoming episode partitions and archive expired ones"""
+	this_month = month_start(date.today())
+	with engine.connect() as conn:
+		if not is_partitioned(conn):
+			raise click.ClickException("pp2965.episodes is not partitioned yet, run partition-episodes first")
+		create_default_partitions(conn, PARTITION_LINKS)
+		created = create_partitions(conn, PARTITION_LINKS, this_month, add_months(this_month, months_ahead))
+		# Expired months are left in the DEFAULT partitions for archive_partitions
+		cutoff = add_months(this_month, -retain_months) if retain_months > 0 else None
+		created += split_default(conn, PARTITION_LINKS, cutoff)
+		conn.commit()
+		for month in sorted(created):
+			print(f"Created partitions for {month:%Y-%m}")
+		if retain_months > 0:
+			for path in archive_partitions(conn, PARTITION_LINKS, cutoff, archive_dir):
+				print(f"Archived {path}")
+
+
+#
+# PRODUCTION SERVER
+#
+# `flask --app server serve` runs the app under gunicorn with several
+# pre-forked worker processes, each with a thread pool:
+#
+#     flask --app server serve --workers 4 --threads 8 --db-max-connections 40
+#
+# The app is imported once in the master (preload) and shared copy-on-write
+# by the workers, so set WARM_UP=1 to compile templates before forking.
+# Each worker gets an equal share of --db-max-connections (the database's
+# connection budget for this deployment), less the LISTEN connection its
+# ChangeNotifier holds outside the pool when CHANGE_FEED_NOTIFY is set, as
+# its pool, with no overflow; replica lag probes go through the replica
+# pools. So the server as a whole stays within the budget. By default
+# there are 2 workers per CPU plus one, but no more than the budget allows.
+# Signals go to the master: HUP restarts the workers gracefully, TTIN/TTOU
+# add/remove a worker, and since the code is preloaded, deploying new code
+# takes USR2 (start a new master) followed by QUIT to the old one.
+#
+
+@app.cli.command('serve')
+@click.option('--bind', default='0.0.0.0:8111', show_default=True)
+@click.option('--workers', type=int, help='Worker processes  [default: 2 per CPU + 1, within --db-max-connections]')
+@click.option('--threads', default=4, show_default=True, type=int, help='Request threads per worker')
+@click.option('--db-max-connections', default=int(os.environ.get('DB_MAX_CONNECTIONS', 20)), show_default=True, type=int,
+	help='Connections all workers together may open to each database (DB_MAX_CONNECTIONS)')
+@click.option('--timeout', default=30, show_default=True, type=int, help='Seconds before a stuck worker is restarted')
+@click.option('--graceful-timeout', default=30, show_default=True, type=int)
+@click.option('--max-requests', default=5000, show_default=True, type=int, help='Recycle workers after this many requests (0 = never)')
+def serve(bind, workers, threads, db_max_connections, timeout, graceful_timeout, max_requests):
+	"""Run the multi-process production server (needs gunicorn)"""
+	try:
+		from gunicorn.app.base import BaseApplication
+	except ImportError:
+		raise click.ClickException("gunicorn is not installed: pip install gunicorn")
+	
+	# Connections a worker opens outside its pool
+	reserved = 1 if CHANGE_FEED_NOTIFY else 0
+	if workers is None:
+		workers = max(1, min((os.cpu_count() or 1) * 2 + 1, db_max_connections // (1 + reserved)))
+	per_worker = db_max_connections // workers - reserved
+	if per_worker < 1:
+		raise click.ClickException(f"--db-max-connections {db_max_connections} is less than "
+			f"{1 + reserved} connection{'s' if reserved else ''} per worker")
+	pool_size = min(per_worker, threads)
+	if pool_size < threads:
+		print(f"note: {threads} threads share {pool_size} connections per worker; extra requests wait for a connection")
+	
+	def when_ready(server):
+		# The master never serves requests; release what the import opened
+		for master_engine in [engine] + replica_engines:
+			master_engine.dispose()
+	
+	# Change streams each hold a thread while open; keep half for other requests
+	stream_limit = int(os.environ.get('CHANGE_FEED_MAX_STREAMS', threads // 2))
+	
+	def post_fork(server, worker):
+		configure_pools(pool_size, 0)
+		configure_stream_limit(stream_limit)
+	
+	options = {
+		'bind': bind,
+		'workers': workers,
+		'threads': threads,
+		'worker_class': 'gthread' if threads > 1 else 'sync',
+		'preload_app': True,
+		'timeout': timeout,
+		'graceful_timeout': graceful_timeout,
+		'max_requests': max_requests,
+		'max_requests_jitter': max_requests // 10,
+		'when_ready': when_ready,
+		'post_fork': post_fork
+	}
+	
+	class ProductionServer(BaseApplication):
+		def load_config(self):
+			for key, value in options.items():
+				self.cfg.set(key, value)
+		
+		def load(self):
+			return app
+	
+	print(f"serving on {bind}: {workers} workers x {threads} threads, {pool_size} DB connections "
+		f"and {stream_limit} change streams per worker")
+	ProductionServer().run()
+
 
+if os.environ.get('WARM_UP') == '1':
+	warm_up()
+	if os.environ.get('STARTUP_PROFILE') == '1':
+		print(startup_report())
+
+
+if __name__ == "__main__":
 	@click.command()
 	@click.option('--debug', is_flag=True)
-	@click.option('--threaded', is_flag=True)
+	@click.option('--threaded/--no-threaded', default=True, show_default=True,
+		help='Serve requests in threads; open change streams block everything else without')
 	@click.argument('HOST', default='0.0.0.0')
 	@click.argument('PORT', default=8111, type=int)
 	def run(debug, threaded, host, port):
@@ -1056,7 +2947,10 @@ if __name__ == "__main__":
 		"""
 
 		HOST, PORT = host, port
+		if not threaded:
+			# A change stream would hold the only thread for as long as it is open
+			configure_stream_limit(0)
 		print("running on %s:%d" % (HOST, PORT))
 		app.run(host=HOST, port=PORT, debug=debug, threaded=threaded)
 
-run()
+	run()
@@ -0,0 +1,8 @@
+/** Purges every utility class not used by the Jinja templates. */
+module.exports = {
+  content: ['./templates/**/*.html'],
+  theme: {
+    extend: {},
+  },
+  plugins: [],
+}
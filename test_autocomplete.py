@@ -0,0 +1,41 @@
+from autocomplete import PrefixIndex
+
+
+INDEX = PrefixIndex([
+	(1, 'Migraine'),
+	(2, 'Migraine with aura'),
+	(3, 'Menstrual migraine'),
+	(4, 'Tension headache'),
+	(5, 'Cluster headache'),
+	(6, 'Mint'),
+])
+
+
+def test_prefix_matches_before_fuzzy():
+	# 'migrane' is no prefix of anything but shares most trigrams with the
+	# migraines; equally similar names come in name order
+	assert [i for i, _ in INDEX.search('migrane')] == [3, 1, 2]
+	# 'mi' prefixes Migraine, Migraine with aura, Mint and the word 'migraine' of 3
+	assert [i for i, _ in INDEX.search('mi')] == [6, 1, 3, 2]
+
+
+def test_fuzzy_needs_a_long_enough_query():
+	assert INDEX.search('mx') == []
+	assert INDEX.search('tension headahce') == [(4, 'Tension headache')]
+
+
+def test_usage_ranks_first():
+	assert [i for i, _ in INDEX.search('mi', usage={2: 5, 3: 1})] == [2, 3, 6, 1]
+	# Usage does not lift a fuzzy match above a prefix match
+	assert [i for i, _ in INDEX.search('headache', usage={1: 100})][:2] == [5, 4]
+
+
+def test_multi_word_prefix():
+	assert INDEX.search('with au') == [(2, 'Migraine with aura')]
+	assert INDEX.search('  MIGRAINE   With ')[0] == (2, 'Migraine with aura')
+	assert [i for i, _ in INDEX.search('headache')][:2] == [5, 4]
+
+
+def test_k_limits_results():
+	assert len(INDEX.search('m', k=2)) == 2
+	assert len(PrefixIndex([]).search('migraine')) == 0
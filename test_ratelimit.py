@@ -0,0 +1,51 @@
+import pytest
+
+import ratelimit
+from ratelimit import MemoryBackend
+
+
+@pytest.fixture
+def clock(monkeypatch):
+	now = [1000.0]
+	monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+	return now
+
+
+def test_burst_then_refused(clock):
+	backend = MemoryBackend()
+	assert [backend.take('a', 1.0, 3)[0] for _ in range(4)] == [True, True, True, False]
+	# Other keys have their own bucket
+	assert backend.take('b', 1.0, 3) == (True, 0.0)
+
+
+def test_retry_after(clock):
+	backend = MemoryBackend()
+	backend.take('a', 0.5, 1)
+	assert backend.take('a', 0.5, 1) == (False, 2.0)
+	clock[0] += 1.5
+	allowed, retry_after = backend.take('a', 0.5, 1)
+	assert not allowed
+	assert retry_after == pytest.approx(0.5)
+
+
+def test_refill(clock):
+	backend = MemoryBackend()
+	for _ in range(2):
+		backend.take('a', 2.0, 2)
+	assert not backend.take('a', 2.0, 2)[0]
+	clock[0] += 0.5
+	assert backend.take('a', 2.0, 2) == (True, 0.0)
+	assert not backend.take('a', 2.0, 2)[0]
+	# Refilling stops at burst
+	clock[0] += 60
+	assert [backend.take('a', 2.0, 2)[0] for _ in range(3)] == [True, True, False]
+
+
+def test_prune_forgets_full_buckets(clock):
+	backend = MemoryBackend()
+	backend.max_keys = 2
+	backend.take('a', 1.0, 1)
+	backend.take('b', 1.0, 1)
+	clock[0] += 10
+	backend.take('c', 1.0, 1)
+	assert set(backend._buckets) == {'c'}
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from validation import EPISODE_FORM, EPISODE_JSON, NAME_FORM, SYNC_REQUEST, ValidationError
+
+
+IDS = {'attack_types': {1}, 'pain_locations': {1}, 'symptoms': {2}, 'triggers': {3}, 'medications': {4}}
+
+
+def errors(schema, data, ids=IDS):
+	with pytest.raises(ValidationError) as raised:
+		schema.validate(data, ids)
+	return raised.value
+
+
+def test_valid_form():
+	values = EPISODE_FORM.validate({'start_datetime': '2024-01-01T10:00', 'intensity': '7',
+		'symptoms': ['2'], 'had_menses': 'on'}, IDS)
+	assert values['start_time'] == datetime(2024, 1, 1, 10)
+	assert values['end_time'] is None
+	assert values['intensity'] == 7
+	assert values['symptoms'] == [2]
+	assert values['had_menses'] is True
+	assert values['user_id'] == 1
+
+
+def test_bounds():
+	assert errors(EPISODE_JSON, {'start_time': '2024-01-01T10:00', 'intensity': 11}).errors == {
+		'intensity': "must be between 1 and 10"}
+	assert 'intensity' in errors(EPISODE_JSON, {'start_time': '2024-01-01T10:00', 'intensity': 0}).errors
+	assert 'intensity' in errors(EPISODE_JSON, {'start_time': '2024-01-01T10:00', 'intensity': 5.5}).errors
+	assert 'intensity' in errors(EPISODE_JSON, {'start_time': '2024-01-01T10:00', 'intensity': True}).errors
+	assert errors(EPISODE_FORM, {'start_datetime': '2024-01-01T10:00', 'intensity': '5',
+		'user_id': '0'}).errors == {'user_id': "must be at least 1"}
+	assert 'name' in errors(NAME_FORM, {'name': 'x' * 201}).errors
+
+
+def test_required_and_blank():
+	error = errors(EPISODE_FORM, {'start_datetime': ' ', 'intensity': ''})
+	assert error.errors == {'start_time': "is required", 'intensity': "is required"}
+	assert errors(NAME_FORM, {'name': '   '}).errors == {'name': "is required"}
+	assert NAME_FORM.validate({'name': '  Nausea '}) == {'name': 'Nausea'}
+
+
+def test_unknown_ids():
+	error = errors(EPISODE_JSON, {'start_time': '2024-01-01T10:00', 'intensity': 5,
+		'attack_type_id': 9, 'triggers': [3, 99]})
+	assert error.unknown_ids
+	assert error.errors == {'attack_type_id': "no attack types with id 9", 'triggers': "no triggers with id 99"}
+	# Without ids the existence checks are skipped
+	assert EPISODE_JSON.validate({'start_time': '2024-01-01T10:00', 'intensity': 5, 'triggers': [99]})['triggers'] == [99]
+
+
+def test_invalid_value_is_not_an_unknown_id():
+	error = errors(EPISODE_JSON, {'start_time': '2024-01-01T10:00', 'intensity': 5, 'symptoms': ['x']})
+	assert not error.unknown_ids
+	assert error.errors == {'symptoms': "must be a whole number"}
+
+
+def test_end_before_start():
+	error = errors(EPISODE_JSON, {'start_time': '2024-01-01T10:00', 'end_time': '2024-01-01T09:00', 'intensity': 5})
+	assert error.errors == {'end_time': "must not be before the start time"}
+	values = EPISODE_JSON.validate({'start_time': '2024-01-01T10:00', 'end_time': '2024-01-01T10:00', 'intensity': 5})
+	assert values['end_time'] == values['start_time']
+
+
+def test_naive_and_aware_times():
+	error = errors(EPISODE_JSON, {'start_time': '2024-01-01T10:00', 'end_time': '2024-01-01T12:00+02:00', 'intensity': 5})
+	assert error.errors == {'end_time': "must not be before the start time"}
+	values = EPISODE_JSON.validate({'start_time': '2024-01-01T10:00+01:00', 'end_time': '2024-01-01T10:30Z', 'intensity': 5})
+	assert values['start_time'].utcoffset() == timedelta(hours=1)
+	assert values['end_time'].tzinfo == timezone.utc
+
+
+def test_validate_all_prefixes_item_index():
+	with pytest.raises(ValidationError) as raised:
+		NAME_FORM.validate_all([{'name': 'a'}, {'name': ''}, 'b'])
+	assert raised.value.errors == {'item 1: name': "is required", 'item 2: item': "must be an object"}
+	with pytest.raises(ValidationError):
+		NAME_FORM.validate_all({'name': 'a'})
+	assert NAME_FORM.validate_all([{'name': 'a'}]) == [{'name': 'a'}]
+
+
+def test_sync_request():
+	assert SYNC_REQUEST.validate({}) == {'user_id': 1, 'sync_token': 0}
+	assert SYNC_REQUEST.validate({'user_id': '3', 'sync_token': 12}) == {'user_id': 3, 'sync_token': 12}
+	assert set(errors(SYNC_REQUEST, {'user_id': 'x', 'sync_token': -1}).errors) == {'user_id', 'sync_token'}
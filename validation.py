@@ -0,0 +1,268 @@
+"""
+Typed validation of posted forms and uploaded JSON.
+
+A Schema is built from Field objects once, at import: each field compiles
+into a small reader function with its key, parser and bounds bound in, so
+validating a request is one pass over a tuple of functions with no
+database access. Readers accept a Flask form (MultiDict) or a JSON object.
+Id fields are checked against sets of known ids that the caller passes in
+(the cached reference data), so a request naming a deleted symptom is
+refused before any statement runs instead of failing half way through its
+transaction on a foreign key.
+"""
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+
+class ValidationError(ValueError):
+	"""
+	Invalid input; errors maps each bad field to a message. unknown_ids is
+	set when an id was not in the known ids, which may just be out of date.
+	"""
+
+	def __init__(self, errors, unknown_ids=False):
+		super().__init__(errors)
+		self.errors = errors
+		self.unknown_ids = unknown_ids
+
+	def __str__(self):
+		return '; '.join(f"{field}: {message}" for field, message in self.errors.items())
+
+
+class UnknownId(ValueError):
+	pass
+
+
+class Field:
+	"""
+	One input value, read from key (default: the field name). A missing or
+	blank value gives default, or an error if the field is required; any
+	other value goes through parse(), which raises ValueError with a message
+	for the user when the value is invalid.
+	"""
+	many = False
+
+	def __init__(self, name, key=None, required=False, default=None):
+		self.name = name
+		self.key = key or name
+		self.required = required
+		self.default = default
+
+	def parse(self, value, ids):
+		return value
+
+	def compile(self):
+		"""A function (data, ids) -> value reading this field"""
+		key, required, default, parse = self.key, self.required, self.default, self.parse
+		if self.many:
+			def read(data, ids):
+				values = data.getlist(key) if hasattr(data, 'getlist') else data.get(key) or []
+				if not isinstance(values, list):
+					raise ValueError("must be a list")
+				return [parse(value, ids) for value in values if value not in (None, '')]
+			return read
+
+		def read(data, ids):
+			value = data.get(key)
+			if value is None or (isinstance(value, str) and not value.strip()):
+				if required:
+					raise ValueError("is required")
+				return default
+			return parse(value, ids)
+		return read
+
+
+class Integer(Field):
+	def __init__(self, name, minimum=None, maximum=None, **options):
+		super().__init__(name, **options)
+		self.minimum = minimum
+		self.maximum = maximum
+
+	def parse(self, value, ids):
+		if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+			raise ValueError("must be a whole number")
+		try:
+			number = int(value.strip() if isinstance(value, str) else value)
+		except (TypeError, ValueError):
+			raise ValueError("must be a whole number")
+		if self.minimum is not None and number < self.minimum:
+			raise ValueError(f"must be between {self.minimum} and {self.maximum}" if self.maximum is not None
+				else f"must be at least {self.minimum}")
+		if self.maximum is not None and number > self.maximum:
+			raise ValueError(f"must be between {self.minimum} and {self.maximum}" if self.minimum is not None
+				else f"must be at most {self.maximum}")
+		return number
+
+
+class Id(Integer):
+	"""An id that must be in ids[kind] when ids are given"""
+
+	def __init__(self, name, kind, **options):
+		super().__init__(name, minimum=1, **options)
+		self.kind = kind
+
+	def parse(self, value, ids):
+		item_id = super().parse(value, ids)
+		if ids is not None and item_id not in ids[self.kind]:
+			raise UnknownId(f"no {self.kind.replace('_', ' ')} with id {item_id}")
+		return item_id
+
+
+class IdList(Id):
+	"""Several ids, from a multi-select (getlist) or a JSON array"""
+	many = True
+
+
+class Number(Field):
+	def __init__(self, name, minimum=None, **options):
+		super().__init__(name, **options)
+		self.minimum = minimum
+
+	def parse(self, value, ids):
+		try:
+			number = Decimal(str(value).strip())
+		except InvalidOperation:
+			raise ValueError("must be a number")
+		if not number.is_finite() or self.minimum is not None and number < self.minimum:
+			raise ValueError(f"must be a number of at least {self.minimum}")
+		return number
+
+
+class DateTime(Field):
+	def parse(self, value, ids):
+		if isinstance(value, datetime):
+			return value
+		try:
+			return datetime.fromisoformat(str(value).strip())
+		except ValueError:
+			raise ValueError("must be a date and time like 2024-01-31T08:00")
+
+
+class Boolean(Field):
+	"""A checkbox ('on' when ticked, absent otherwise) or a JSON boolean"""
+
+	def __init__(self, name, **options):
+		super().__init__(name, default=False, **options)
+
+	def parse(self, value, ids):
+		if value in (True, 1, 'on', 'true', '1'):
+			return True
+		if value in (False, 0, 'off', 'false', '0'):
+			return False
+		raise ValueError("must be true or false")
+
+
+class Text(Field):
+	def __init__(self, name, max_length=None, strip=False, **options):
+		super().__init__(name, **options)
+		self.max_length = max_length
+		self.strip = strip
+
+	def parse(self, value, ids):
+		if not isinstance(value, str):
+			raise ValueError("must be text")
+		if self.strip:
+			value = value.strip()
+		if self.max_length is not None and len(value) > self.max_length:
+			raise ValueError(f"must be at most {self.max_length} characters")
+		return value
+
+
+class Schema:
+	"""
+	Fields validated together, plus checks across fields given as
+	(field name, message, predicate of the parsed values)
+	"""
+
+	def __init__(self, *fields, checks=()):
+		self.names = [field.name for field in fields]
+		self._readers = tuple((field.name, field.compile()) for field in fields)
+		self._checks = checks
+
+	def validate(self, data, ids=None):
+		"""
+		The parsed values of data keyed by field name; raises ValidationError
+		listing every invalid field. ids maps an id kind to the set of
+		existing ids (None skips the existence checks).
+		"""
+		if not hasattr(data, 'get'):
+			raise ValidationError({'item': "must be an object"})
+		values, errors, unknown_ids = {}, {}, False
+		for name, read in self._readers:
+			try:
+				values[name] = read(data, ids)
+			except UnknownId as e:
+				errors[name], unknown_ids = str(e), True
+			except ValueError as e:
+				errors[name] = str(e)
+		if not errors:
+			for name, message, check in self._checks:
+				try:
+					valid = check(values)
+				except TypeError:  # e.g. comparing a time with a UTC offset to one without
+					valid = False
+				if not valid:
+					errors[name] = message
+		if errors:
+			raise ValidationError(errors, unknown_ids)
+		return values
+
+	def validate_all(self, items, ids=None):
+		"""
+		The parsed values of each of a list of items; raises one
+		ValidationError with the errors of all items, prefixed with their
+		index if there are several.
+		"""
+		if not isinstance(items, list):
+			raise ValidationError({'items': "must be a list"})
+		values, errors, unknown_ids = [], {}, False
+		for index, item in enumerate(items):
+			try:
+				values.append(self.validate(item, ids))
+			except ValidationError as e:
+				prefix = f"item {index}: " if len(items) > 1 else ''
+				errors.update({prefix + field: message for field, message in e.errors.items()})
+				unknown_ids = unknown_ids or e.unknown_ids
+		if errors:
+			raise ValidationError(errors, unknown_ids)
+		return values
+
+
+NAME_MAX_LENGTH = 200
+NOTES_MAX_LENGTH = 10000
+
+
+def _episode_schema(start_key, end_key, *fields):
+	return Schema(
+		DateTime('start_time', key=start_key, required=True),
+		DateTime('end_time', key=end_key),
+		Integer('intensity', minimum=1, maximum=10, required=True),
+		Id('attack_type_id', 'attack_types'),
+		Boolean('had_menses'),
+		Text('notes', max_length=NOTES_MAX_LENGTH, default=''),
+		IdList('pain_locations', 'pain_locations'),
+		IdList('symptoms', 'symptoms'),
+		IdList('triggers', 'triggers'),
+		IdList('medications', 'medications'),
+		*fields,
+		checks=(('end_time', "must not be before the start time",
+			lambda values: values['end_time'] is None or values['end_time'] >= values['start_time']),))
+
+
+# episode_form.html posts start_datetime/end_datetime, /sync uploads start_time/end_time
+EPISODE_FORM = _episode_schema('start_datetime', 'end_datetime', Integer('user_id', minimum=1, default=1))
+# The edit form also posts the version it was rendered from, for the compare-and-swap
+EPISODE_UPDATE_FORM = _episode_schema('start_datetime', 'end_datetime',
+	Integer('version', minimum=1, required=True))
+# Edits uploaded to /sync carry the version the client last saw, if any
+EPISODE_JSON = _episode_schema('start_time', 'end_time', Integer('version', minimum=1))
+# The envelope of a /sync upload; its episodes are EPISODE_JSON
+SYNC_REQUEST = Schema(
+	Integer('user_id', minimum=1, default=1),
+	Integer('sync_token', minimum=0, default=0))
+
+MEDICATION_FORM = Schema(
+	Text('generic_name', max_length=NAME_MAX_LENGTH, strip=True, required=True),
+	Number('milligrams', minimum=0),
+	Text('route', max_length=NAME_MAX_LENGTH, strip=True, default=''))
+NAME_FORM = Schema(Text('name', max_length=NAME_MAX_LENGTH, strip=True, required=True))